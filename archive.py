@@ -0,0 +1,155 @@
+"""
+Compact screenshot archive.
+
+Instead of two full PNGs per match, only the parts of a frame recognition
+looks at are kept: the level box strips and template regions, in 2560x1440
+coordinates. The crops are appended to one pack file and every frame gets a
+line in an index next to it:
+
+    archive.pack          PNG encoded crops, back to back
+    archive.index.jsonl   {"name": ..., "size": [w, h],
+                           "regions": {region: [x, y, w, h, offset, length]}}
+
+A downscaled preview of the whole frame can be stored with it. read() puts
+the crops back on an empty frame, so recognize_scoreboard and match_result
+run on it unchanged without decoding a full screenshot.
+
+    python archive.py pack ./scoreboards     adds the PNGs found there
+    python archive.py extract NAME out.png   writes the preview of a frame
+"""
+
+import os
+import sys
+from os.path import join
+
+import cv2
+import numpy as np
+
+import layouts
+import storage
+
+pack_file = './scoreboards/archive.pack'
+index_file = './scoreboards/archive.index.jsonl'
+# fast PNG compression, the crops are small
+compression = 1
+preview_quality = 80
+
+
+def encode(image, extension='.png'):
+    params = [cv2.IMWRITE_PNG_COMPRESSION, compression] if extension == '.png' else [
+        cv2.IMWRITE_JPEG_QUALITY, preview_quality]
+    ok, data = cv2.imencode(extension, image, params)
+    if not ok:
+        raise ValueError(f"Can't encode {image.shape} as {extension}")
+    return data.tobytes()
+
+
+class Archive:
+    def __init__(self, pack_path=pack_file, index_path=index_file):
+        self.pack_path = pack_path
+        self.index_path = index_path
+        self.index = {entry['name']: entry for entry in storage.iter_matches(index_path)}
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def names(self):
+        return list(self.index)
+
+    def add(self, name, img, regions, preview_scale=0):
+        """
+        Stores the regions (a dict of name -> (x, y, w, h)) of a base size
+        frame, and a preview of the frame scaled by preview_scale if it is set
+        """
+        entry = {'name': name, 'size': [img.shape[1], img.shape[0]], 'regions': {}}
+        with open(self.pack_path, 'ab') as file:
+            for region, (x, y, w, h) in regions.items():
+                crop = img[y: y + h, x: x + w]
+                data = encode(crop)
+                entry['regions'][region] = [x, y, crop.shape[1], crop.shape[0], file.tell(), len(data)]
+                file.write(data)
+            if preview_scale:
+                preview = cv2.resize(img, None, fx=preview_scale, fy=preview_scale, interpolation=cv2.INTER_AREA)
+                data = encode(preview, '.jpg')
+                entry['preview'] = [preview.shape[1], preview.shape[0], file.tell(), len(data)]
+                file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        # the index line goes last, a crash before it only leaves unused bytes in the pack
+        storage.append_match(self.index_path, entry)
+        self.index[name] = entry
+
+    def read_bytes(self, file, offset, length):
+        file.seek(offset)
+        return np.frombuffer(file.read(length), dtype=np.uint8)
+
+    def read(self, name):
+        """
+        Returns the frame with only its archived regions filled in, the rest is black
+        """
+        entry = self.index[name]
+        img = np.zeros((entry['size'][1], entry['size'][0], 3), dtype=np.uint8)
+        with open(self.pack_path, 'rb') as file:
+            for x, y, w, h, offset, length in entry['regions'].values():
+                img[y: y + h, x: x + w] = cv2.imdecode(self.read_bytes(file, offset, length), cv2.IMREAD_COLOR)
+        return img
+
+    def read_preview(self, name):
+        entry = self.index[name]
+        if 'preview' not in entry:
+            return None
+        with open(self.pack_path, 'rb') as file:
+            return cv2.imdecode(self.read_bytes(file, *entry['preview'][2:]), cv2.IMREAD_COLOR)
+
+
+def open_dir(path):
+    """
+    The archive kept in the screenshots directory path
+    """
+    return Archive(join(path, os.path.basename(pack_file)), join(path, os.path.basename(index_file)))
+
+
+def list_screenshots(path, packed):
+    """
+    Sorted names of the screenshots in path, saved as PNGs or in its archive
+    """
+    files = set(f for f in os.listdir(path) if f.startswith('scoreboard') and f.endswith('.png'))
+    return sorted(files | set(packed.names()))
+
+
+def read_screenshot(path, name, packed):
+    # packed screenshots only decode the regions recognition looks at
+    if name in packed:
+        return packed.read(name)
+    return cv2.imread(join(path, name))
+
+
+def pack(path):
+    import start
+
+    packed = open_dir(path)
+    files = sorted(f for f in os.listdir(path) if f.startswith('scoreboard') and f.endswith('.png'))
+    added = 0
+    for f in files:
+        if f in packed:
+            continue
+        img = cv2.imread(join(path, f))
+        img = layouts.to_base(img, start.get_layout(img))
+        packed.add(f, img, start.get_archive_regions(f), start.archive_preview_scale)
+        added += 1
+    print(f"Packed {added} of {len(files)} screenshots into {packed.pack_path}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'pack':
+        pack(sys.argv[2])
+    elif len(sys.argv) >= 4 and sys.argv[1] == 'extract':
+        preview = Archive().read_preview(sys.argv[2])
+        if preview is None:
+            print(f"No preview stored for {sys.argv[2]}")
+            exit(1)
+        cv2.imwrite(sys.argv[3], preview)
+    else:
+        print('Usage: python archive.py pack ./scoreboards')
+        print('       python archive.py extract scoreboard_2020-08-12-01-48-38.png out.png')
+        exit(1)
@@ -0,0 +1,193 @@
+"""
+Microbenchmarks for the recognition hot paths.
+
+    python bench.py [--fixtures DIR] [--baseline bench_baseline.json]
+                    [--save-baseline] [--threshold 0.2]
+
+Fixture frames are the first scoreboard / result pair found in the fixtures
+directory (./scoreboards by default), or synthetic frames built from the
+templates when there is none. Results are written to bench_results.json.
+With a baseline, the run fails if the median of any benchmark got slower by
+more than the threshold.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from os.path import exists, join
+
+import cv2
+import numpy as np
+
+import archive
+import pytesseract_v2 as pytesseract
+import start
+
+results_file = 'bench_results.json'
+baseline_file = 'bench_baseline.json'
+
+
+def find_fixtures(path):
+    if not os.path.isdir(path):
+        return None
+    packed = archive.open_dir(path)
+    files = archive.list_screenshots(path, packed)
+    for f in files:
+        if f.startswith('scoreboard_result_'):
+            scoreboard_file = f.replace('scoreboard_result_', 'scoreboard_')
+            if scoreboard_file in files:
+                return (archive.read_screenshot(path, scoreboard_file, packed),
+                        archive.read_screenshot(path, f, packed))
+    return None
+
+
+def make_synthetic_fixtures():
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 256, (1440, 2560, 3), dtype=np.uint8)
+    scoreboard = background.copy()
+    template = start.scoreboard_template
+    height, width = template['template'].shape[:2]
+    scoreboard[template['y']: template['y'] + height, template['x']: template['x'] + width] = template['template']
+    result = background.copy()
+    template = start.victory_template
+    result[template['y']: template['y'] + template['h'], template['x']: template['x'] + template['w']] = template['template']
+    return scoreboard, result
+
+
+def make_level_crop():
+    crop = np.full((68, 120), 255, dtype=np.uint8)
+    cv2.putText(crop, '42', (10, 55), cv2.FONT_HERSHEY_SIMPLEX, 1.8, 0, 4)
+    return crop
+
+
+def measure(func, repeat, warmup=2):
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    # tracing slows down every allocation, so memory gets its own untimed run
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    timings = np.array(timings) * 1000
+    return {
+        'repeat': repeat,
+        'mean_ms': float(timings.mean()),
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p90_ms': float(np.percentile(timings, 90)),
+        'p99_ms': float(np.percentile(timings, 99)),
+        'fps': float(1000 / timings.mean()),
+        # python and numpy allocations only, OpenCV buffers are not traced
+        'peak_memory_kb': peak / 1024,
+    }
+
+
+def quiet(func):
+    def wrapper():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func()
+    return wrapper
+
+
+def without_cascade(func):
+    def wrapper():
+        start.use_match_cascade = False
+        try:
+            return func()
+        finally:
+            start.use_match_cascade = True
+    return wrapper
+
+
+def startup(module):
+    # a fresh interpreter importing the module, as when a tool is started
+    return lambda: subprocess.run([sys.executable, '-c', f'import {module}'], check=True)
+
+
+def get_benchmarks(scoreboard, result, real_fixtures):
+    level_crop = make_level_crop()
+    temp_dir = tempfile.mkdtemp(prefix='bench_')
+    benchmarks = {
+        'is_matched': (lambda: start.is_matched(scoreboard, start.scoreboard_template), 200),
+        'match_result': (lambda: start.match_result(result), 200),
+        'match_result_no_banner': (lambda: start.match_result(scoreboard), 200),
+        'result_scores': (without_cascade(lambda: start.match_result(scoreboard)), 200),
+        'png_save': (lambda: cv2.imwrite(join(temp_dir, 'frame.png'), scoreboard,
+                                         [cv2.IMWRITE_PNG_COMPRESSION, 9]), 5),
+        'startup_start': (startup('start'), 5),
+        'startup_rescan': (startup('rescan'), 5),
+    }
+    try:
+        pytesseract.get_tesseract_version()
+        benchmarks['image_to_string'] = (lambda: pytesseract.image_to_string(
+            level_crop, config=start.config_number), 20)
+        if real_fixtures:
+            benchmarks['recognize_scoreboard'] = (quiet(lambda: start.recognize_scoreboard(scoreboard)), 10)
+        else:
+            print('Skipping recognize_scoreboard: no scoreboard fixture')
+    except pytesseract.TesseractNotFoundError:
+        print('Skipping image_to_string and recognize_scoreboard: tesseract not found')
+    return benchmarks
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        change = stats['p50_ms'] / baseline[name]['p50_ms'] - 1
+        print(f"{name:24} {baseline[name]['p50_ms']:9.3f} -> {stats['p50_ms']:9.3f} ms ({change:+.1%})")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the recognition hot paths')
+    parser.add_argument('--fixtures', default='./scoreboards')
+    parser.add_argument('--baseline', default=baseline_file)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed median slowdown before failing, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    fixtures = find_fixtures(args.fixtures)
+    real_fixtures = fixtures is not None
+    scoreboard, result = fixtures if real_fixtures else make_synthetic_fixtures()
+    # no OCR caching, every call should do the full work
+    pytesseract.disable_cache()
+
+    results = {}
+    for name, (func, repeat) in get_benchmarks(scoreboard, result, real_fixtures).items():
+        results[name] = measure(func, repeat)
+        stats = results[name]
+        print(f"{name:24} p50 {stats['p50_ms']:9.3f} ms  p90 {stats['p90_ms']:9.3f} ms  "
+              f"p99 {stats['p99_ms']:9.3f} ms  {stats['fps']:9.1f}/s  peak {stats['peak_memory_kb']:9.1f} KB")
+
+    with open(results_file, 'w') as file:
+        json.dump(results, file, indent=1)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=1)
+        print(f"Saved baseline to {args.baseline}")
+    elif exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions:
+            print('Regressed:', ', '.join(regressions))
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
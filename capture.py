@@ -0,0 +1,309 @@
+"""
+Frame sources for the main loop.
+
+ScreenRecorderSource captures the running game on Windows. ReplaySource feeds
+frames from a directory of PNGs or a video file as fast as they are consumed,
+so the state machine, recognition and persistence can run headless:
+
+    python start.py --replay ./scoreboards
+    python start.py --replay recording.mp4
+
+A replay writes its state, results and screenshots to ./replay_output, or
+the directory given with --replay-output.
+"""
+
+import os
+import re
+import time
+
+import cv2
+
+import archive
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+# window states, as in WINDOWPLACEMENT.showCmd
+normal = 1
+minimized = 2
+
+
+class CaptureError(RuntimeError):
+    pass
+
+
+class CaptureSource:
+    # live sources are paced by the poll scheduler, replays run as fast as possible
+    live = True
+
+    def open(self):
+        pass
+
+    def get_state(self):
+        """
+        Returns normal, minimized, or None once there is nothing to capture
+        """
+        return normal
+
+    def get_frame(self):
+        """
+        Returns (pil_image, frame_time), frame_time is used in file names
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def find_pid_by_name(process_name):
+    '''
+    Get a list of all the PIDs of a all the running process whose name contains
+    the given string process_name
+    '''
+    import psutil
+
+    process_objects = []
+    # only the name is read for every process, the rest for the matching ones
+    for proc in psutil.process_iter(['name']):
+        try:
+            # Check if process name contains the given name string.
+            if process_name.lower() in (proc.info['name'] or '').lower():
+                process_objects.append(proc.as_dict(attrs=['pid', 'name', 'create_time']))
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            pass
+    return process_objects
+
+
+def get_pid():
+    overwatch_pid = None
+    while overwatch_pid is None:
+        processes = find_pid_by_name('overwatch.exe')
+        if processes:
+            overwatch_pid = processes[0]['pid']
+        else:
+            time.sleep(3)
+    return overwatch_pid
+
+
+class WindowState:
+    """
+    Finds the game process and reports the state of its window
+    """
+    pid = None
+
+    def find_process(self):
+        """
+        Waits until the game is running and returns its PID
+        """
+        raise NotImplementedError
+
+    def get_state(self):
+        """
+        Returns normal, minimized, or None when the game has no window of a
+        resolution with a layout profile
+        """
+        raise NotImplementedError
+
+
+class Win32WindowState(WindowState):
+    """
+    Enumerates the top-level windows only to find the game window. After
+    that every check is a few calls on the cached handle, until the handle
+    stops being a window of the game process
+    """
+
+    def __init__(self):
+        self.hwnd = None
+
+    def find_process(self):
+        self.pid = get_pid()
+        self.hwnd = None
+        return self.pid
+
+    def is_game_window(self, hwnd):
+        import win32gui
+        import win32process
+
+        return win32gui.IsWindow(hwnd) and win32process.GetWindowThreadProcessId(hwnd)[1] == self.pid
+
+    def find_window(self):
+        import pywintypes
+        import win32gui
+
+        found = []
+
+        def callback(hwnd, arg):
+            if self.is_game_window(hwnd) and self.get_window_state(hwnd) is not None:
+                found.append(hwnd)
+                # stops the enumeration at the game window
+                return False
+            return True
+        try:
+            win32gui.EnumWindows(callback, None)
+        except pywintypes.error:
+            # EnumWindows reports a callback that stopped it early as a failure
+            if not found:
+                raise
+        return found[0] if found else None
+
+    def get_window_state(self, hwnd):
+        import win32gui
+
+        placement = win32gui.GetWindowPlacement(hwnd)
+        # any visible window with an area, start.get_layout picks or derives the layout from the frame size
+        left, top, right, bottom = placement[4]
+        if win32gui.IsWindowVisible(hwnd) and right > left and bottom > top:
+            return placement[1]
+        return None
+
+    def get_state(self):
+        if self.hwnd is None or not self.is_game_window(self.hwnd):
+            self.hwnd = self.find_window()
+            if self.hwnd is None:
+                return None
+        return self.get_window_state(self.hwnd)
+
+
+class FakeWindowState(WindowState):
+    """
+    Plays back a list of window states, one per get_state() call, then keeps
+    returning final. Drives the minimized / closed paths without a game
+    """
+
+    def __init__(self, states=(), final=normal, pid=0):
+        self.states = list(states)
+        self.final = final
+        self.pid = pid
+        self.calls = 0
+
+    def find_process(self):
+        return self.pid
+
+    def get_state(self):
+        self.calls += 1
+        return self.states.pop(0) if self.states else self.final
+
+
+class ScreenRecorderSource(CaptureSource):
+    def __init__(self, log=print, window=None):
+        from screen_recorder_sdk import screen_recorder
+
+        self.screen_recorder = screen_recorder
+        self.log = log
+        self.window = window or Win32WindowState()
+        self.pid = None
+
+    def open(self):
+        import ctypes
+
+        if ctypes.windll.shell32.IsUserAnAdmin() == 0:
+            self.log('Please run as administrator')
+            exit(0)
+        self.log('-- Searching for Overwatch.exe')
+        self.pid = self.window.find_process()
+        self.log('-- Overwatch PID is', self.pid)
+        while self.window.get_state() == minimized:
+            self.log('-- Overwatch is minimized')
+            time.sleep(5)
+        self.log('-- Overwatch is open, initializing')
+        time.sleep(4)  # Pause before initializing
+        # self.screen_recorder.enable_dev_log()
+        self.screen_recorder.disable_log()
+        self.screen_recorder.init_resources(self.pid)
+        self.log('-- Initialized resources')
+
+    def get_state(self):
+        return self.window.get_state()
+
+    def get_frame(self):
+        try:
+            pil_image = self.screen_recorder.get_screenshot(1)
+        except self.screen_recorder.RecorderError as err:
+            raise CaptureError(err)
+        return pil_image, time.strftime("%Y-%m-%d-%H-%M-%S")
+
+    def close(self):
+        self.screen_recorder.free_resources()
+
+
+def get_capture_time(filename):
+    found = re.search(r'\d{4}(-\d\d){5}', os.path.basename(filename))
+    return found.group(0) if found else None
+
+
+def get_replay_order(filename):
+    """
+    Sorts archived screenshots by capture time, files without one by their
+    mtime. A result screenshot is named after its scoreboard, so it goes
+    right after it
+    """
+    capture_time = get_capture_time(filename)
+    if capture_time is None and os.path.isfile(filename):
+        capture_time = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime(os.path.getmtime(filename)))
+    return capture_time or '', 'scoreboard_result_' in os.path.basename(filename), filename
+
+
+class ReplaySource(CaptureSource):
+    live = False
+    video_extensions = ('.mp4', '.mkv', '.avi', '.mov', '.webm')
+
+    def __init__(self, path, window=None):
+        self.path = path
+        # a FakeWindowState can play minimized or closed game states between the frames
+        self.window = window
+        self.files = None
+        self.packed = None
+        self.video = None
+        self.index = 0
+        self.next_frame = None
+
+    def open(self):
+        if os.path.isdir(self.path):
+            # screenshots kept in the archive of the directory are replayed along with the PNGs
+            self.packed = archive.open_dir(self.path)
+            names = set(f for f in os.listdir(self.path) if f.lower().endswith('.png')) | set(self.packed.names())
+            self.files = sorted((os.path.join(self.path, f) for f in names), key=get_replay_order)
+        elif self.path.lower().endswith(self.video_extensions):
+            self.video = cv2.VideoCapture(self.path)
+            if not self.video.isOpened():
+                raise CaptureError(f"Can't open video {self.path}")
+        else:
+            self.files = [self.path]
+
+    def get_state(self):
+        if self.window is not None:
+            state = self.window.get_state()
+            if state != normal:
+                return state
+        return self.get_frames_state()
+
+    def get_frames_state(self):
+        if self.video is not None:
+            if self.next_frame is None:
+                ok, frame = self.video.read()
+                self.next_frame = frame if ok else None
+            return normal if self.next_frame is not None else None
+        return normal if self.index < len(self.files) else None
+
+    def get_frame(self):
+        if self.get_frames_state() is None:
+            return None, None
+        self.index += 1
+        if self.video is not None:
+            frame, self.next_frame = self.next_frame, None
+            pil_image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            return pil_image, f'replay-{self.index:06d}'
+        filename = self.files[self.index - 1]
+        if self.packed is not None and os.path.basename(filename) in self.packed:
+            frame = self.packed.read(os.path.basename(filename))
+            pil_image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        else:
+            pil_image = Image.open(filename).convert('RGB')
+        # keep the original capture time of archived screenshots
+        return pil_image, get_capture_time(filename) or f'replay-{self.index:06d}'
+
+    def close(self):
+        if self.video is not None:
+            self.video.release()
@@ -0,0 +1,43 @@
+"""
+Votes on the scoreboard rows over several frames, so a frame caught mid-fade
+or a misread digit does not decide a player's level on its own.
+"""
+
+from collections import Counter
+
+# what a reading of a row is made of, as in the players of recognize_scoreboard
+fields = ('level', 'level_base', 'color', 'stars')
+
+
+class Consensus:
+    """
+    Counts the (level, level_base, color, stars) readings of every row. A row
+    is settled once one reading got agree votes; voting is done when every
+    row is settled or after max_frames frames. Ties go to the reading seen
+    first
+    """
+
+    def __init__(self, rows=12, agree=2, max_frames=8):
+        self.votes = [Counter() for _ in range(rows)]
+        self.agree = agree
+        self.max_frames = max_frames
+        self.frames = 0
+
+    def add(self, players):
+        """
+        Adds the readings of one frame, players is {row: player} and can hold
+        only some of the rows
+        """
+        self.frames += 1
+        for row, player in players.items():
+            self.votes[row][tuple(player[field] for field in fields)] += 1
+
+    def unsettled(self):
+        return [row for row, votes in enumerate(self.votes)
+                if not votes or votes.most_common(1)[0][1] < self.agree]
+
+    def is_done(self):
+        return self.frames >= self.max_frames or not self.unsettled()
+
+    def get_players(self):
+        return [dict(zip(fields, votes.most_common(1)[0][0])) for votes in self.votes]
@@ -0,0 +1,177 @@
+"""
+Nearest-neighbour classifier for player level digits.
+
+Levels are drawn in one fixed font, so instead of running Tesseract on every
+crop we segment the binarized crop into glyphs and compare them with a bank
+of labeled glyphs cut from archived scoreboards.
+
+Build the bank with `python digits.py train` and it will be picked up by
+start.py automatically.
+"""
+
+import json
+import sys
+from os.path import basename, exists
+
+import cv2
+import numpy as np
+
+bank_file = './digits_bank.npz'
+glyph_size = (20, 28)
+# columns need at least this many ink pixels to count as part of a glyph
+min_column_ink = 2
+# narrower runs of ink columns are noise, not digits (crops are 4x upscaled)
+min_glyph_width = 8
+# relative distance gap between the best and the second best digit
+min_margin = 0.2
+max_samples_per_digit = 300
+
+
+def get_ink(crop):
+    # digits are the minority color of the binarized crop, whichever it is
+    if crop.mean() > 127:
+        return crop < 128
+    return crop >= 128
+
+
+def segment_glyphs(crop):
+    ink = get_ink(crop)
+    columns = ink.sum(axis=0) >= min_column_ink
+    # start/end indices of runs of inked columns
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], columns.view(np.int8), [0]))))
+    glyphs = []
+    for start, end in zip(edges[::2], edges[1::2]):
+        if end - start < min_glyph_width:
+            continue
+        rows = np.flatnonzero(ink[:, start:end].any(axis=1))
+        glyph = ink[rows[0]: rows[-1] + 1, start:end].astype(np.float32)
+        glyphs.append(cv2.resize(glyph, glyph_size,
+                                 interpolation=cv2.INTER_AREA).ravel())
+    if not glyphs:
+        return np.empty((0, glyph_size[0] * glyph_size[1]), dtype=np.float32)
+    return np.stack(glyphs)
+
+
+class GlyphBank:
+    def __init__(self, vectors, labels):
+        # sort by label so per-digit minimums are one reduceat call
+        order = np.argsort(labels, kind='stable')
+        self.vectors = vectors[order].astype(np.float32)
+        self.labels = labels[order]
+        self.digits, self.starts = np.unique(self.labels, return_index=True)
+        self.norms = (self.vectors ** 2).sum(axis=1)
+
+    def classify(self, glyphs):
+        """
+        Returns (digits, margins) for an array of glyph vectors
+        """
+        distances = (glyphs ** 2).sum(axis=1)[:, None] - 2 * glyphs @ self.vectors.T + self.norms
+        per_digit = np.minimum.reduceat(distances, self.starts, axis=1)
+        if per_digit.shape[1] < 2:
+            return self.digits[per_digit.argmin(axis=1)], np.zeros(len(glyphs))
+        nearest = np.partition(per_digit, 1, axis=1)
+        best = np.maximum(nearest[:, 0], 0)
+        second = np.maximum(nearest[:, 1], 1e-6)
+        return self.digits[per_digit.argmin(axis=1)], (second - best) / second
+
+    def read(self, crop):
+        """
+        Returns (text, margin) of a binarized level crop, margin is 0 if no
+        digits were found
+        """
+        glyphs = segment_glyphs(crop)
+        if not len(glyphs):
+            return '', 0.0
+        digits, margins = self.classify(glyphs)
+        return ''.join(str(digit) for digit in digits), float(margins.min())
+
+
+def load_bank(path=bank_file):
+    if not exists(path):
+        return None
+    with np.load(path) as data:
+        return GlyphBank(data['vectors'], data['labels'])
+
+
+def get_known_levels(results_file):
+    levels = {}
+    if not exists(results_file):
+        return levels
+    with open(results_file) as file:
+        for match in json.load(file):
+            if 'scoreboard_file' in match:
+                levels[basename(match['scoreboard_file'])] = [
+                    player['level'] for player in match['players']]
+    return levels
+
+
+def train(path='./scoreboards', results_file='results.json', output=bank_file):
+    """
+    Cuts level crops out of archived scoreboards and stores their glyphs.
+    Labels come from results.json, or from Tesseract for unknown files
+    """
+    import archive
+    import pytesseract_v2 as pytesseract
+    import start
+
+    known_levels = get_known_levels(results_file)
+    packed = archive.open_dir(path)
+    scoreboards = [f for f in archive.list_screenshots(path, packed) if not f.startswith('scoreboard_result')]
+    samples = {digit: {} for digit in range(10)}
+    for scoreboard_file in scoreboards:
+        print('File:', scoreboard_file)
+        img = archive.read_screenshot(path, scoreboard_file, packed)
+        levels = known_levels.get(scoreboard_file)
+        try:
+            rows = start.scan_rows(img)
+        except Exception as e:
+            print(f"Skipping {scoreboard_file}: {e}")
+            continue
+        for player_number, row in enumerate(rows):
+            if row is None:
+                continue
+            # one unreadable row does not cost the glyphs of the other eleven
+            try:
+                crop = start.preprocess_level_crop(row['crop'], row['color'])
+                if levels is not None:
+                    label = levels[player_number]
+                else:
+                    label = pytesseract.image_to_string(crop, config=start.config_number)
+                glyphs = segment_glyphs(crop)
+            except Exception as e:
+                print(f"Skipping player {player_number + 1} of {scoreboard_file}: {e}")
+                continue
+            if not label.isdigit() or len(label) != len(glyphs):
+                continue
+            for digit, glyph in zip(label, glyphs):
+                # identical glyphs add nothing to the bank
+                samples[int(digit)].setdefault(glyph.tobytes(), glyph)
+
+    vectors, labels = [], []
+    rng = np.random.default_rng(0)
+    for digit, glyphs in samples.items():
+        glyphs = list(glyphs.values())
+        if len(glyphs) > max_samples_per_digit:
+            glyphs = [glyphs[i] for i in rng.choice(
+                len(glyphs), max_samples_per_digit, replace=False)]
+        print(f"Digit {digit}: {len(glyphs)} glyphs")
+        vectors += glyphs
+        labels += [digit] * len(glyphs)
+    if not vectors:
+        print('No glyphs found, bank not saved')
+        return None
+    np.savez_compressed(output, vectors=np.stack(vectors), labels=np.array(labels))
+    print(f"Saved {len(vectors)} glyphs to {output}")
+    return load_bank(output)
+
+
+def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == 'train':
+        train(*sys.argv[2:4])
+    else:
+        sys.stderr.write('Usage: python digits.py train [scoreboards_dir] [results_file]\n')
+        exit(2)
+
+
+if __name__ == '__main__':
+    main()
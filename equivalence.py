@@ -0,0 +1,317 @@
+"""
+Checks that the optimized recognition code gives the same answers as the
+code it replaced.
+
+    python equivalence.py [--fixtures DIR] [--synthetic 200]
+
+The vectorized analyse_rows is compared to the original pixel by pixel row
+scanner on every scoreboard in the fixtures directory (./scoreboards by
+default, PNGs or packed), and on synthetic frames with random level boxes.
+The result template scores of matcher.TemplateMatcher are compared to
+cv2.matchTemplate on every screenshot and a synthetic result frame, scaled
+to each of layout_sizes. Synthetic scoreboards scaled to each of
+row_layout_sizes have to give the colors and stars they give at 2560x1440. Exits with 1 when any output differs.
+"""
+
+import argparse
+
+import cv2
+import numpy as np
+
+import archive
+import layouts
+import start
+
+# colors the synthetic level boxes are painted with, next to random ones
+star_backgrounds = ([252, 252, 252], [181, 106, 86])
+gold = [40, 190, 230]
+# frame sizes the result templates are checked at, the screenshots are scaled into their HUD area
+layout_sizes = ((2560, 1440), (1920, 1080), (3440, 1440))
+# frame sizes the row scanner is checked at against its 2560x1440 reading
+row_layout_sizes = ((1920, 1080), (3840, 2160), (3440, 1440))
+# TemplateMatcher works in float32, cv2.matchTemplate in double
+score_tolerance = 1e-4
+
+
+def get_pixel_diff(pixel1, pixel2):
+    return max(abs(int(pixel1[0]) - int(pixel2[0])), abs(int(pixel1[1]) - int(pixel2[1])), abs(int(pixel1[2]) - int(pixel2[2])))
+
+
+def is_pixels_almost_equal(pixel1, pixel2):
+    return get_pixel_diff(pixel1, pixel2) < 5
+
+
+def is_golden_color(bgr_pixel):
+    max_color = max(bgr_pixel)
+    if max_color != bgr_pixel[2]:
+        return False
+    min_color = min(bgr_pixel)
+    hue = 60 * (int(bgr_pixel[1]) - int(bgr_pixel[0])
+                ) / (int(max_color) - int(min_color))
+    if hue < 0:
+        hue = hue + 360
+    return hue > 35 and hue < 55
+
+
+def is_star_bg(pixel, color_pixel):
+    # diamond color of player
+    if is_pixels_almost_equal(color_pixel, start.border_colors[3]):
+        # dark blue background color of stars block
+        return is_pixels_almost_equal(pixel, [181, 106, 86])
+    # white background color of stars block
+    return is_pixels_almost_equal(pixel, [252, 252, 252])
+
+
+def scan_player_row(img, player_number):
+    """
+    The row scanner as it was before analyse_rows, down to where the level
+    crop is cut. Returns (stable_offsets, stars, has_gold_border)
+    """
+    left_dot = start.level_boxes_top_left[player_number]
+    width_to_check = start.width_to_check
+    first_pixel = img[left_dot[1], left_dot[0]]
+    prev_stable_pixel = img[left_dot[1], left_dot[0]]
+    stable_offsets = []
+    stars = -1
+    star_bg_start = -1
+    has_gold_border = False
+    for width_offset in range(width_to_check):
+        current_pixel = img[left_dot[1], left_dot[0] + width_offset]
+        next_pixel = img[left_dot[1], left_dot[0] + width_offset + 1]
+        next_next_pixel = img[left_dot[1], left_dot[0] + width_offset + 2]
+        if stable_offsets:
+            if is_pixels_almost_equal(current_pixel, first_pixel):
+                # Got to background again, end the loop
+                stars = 0
+                stable_offsets.append(width_offset)
+                break
+        else:
+            # Still on first background block, but color is different - check if we have a golden border here
+            if is_golden_color(current_pixel):
+                has_gold_border = True
+
+        diff = get_pixel_diff(current_pixel, prev_stable_pixel)
+        diff_next = get_pixel_diff(current_pixel, next_pixel)
+        diff_next_next = get_pixel_diff(next_pixel, next_next_pixel)
+        if diff > 35 and diff_next < 5 and diff_next_next < 5:
+            if stable_offsets and is_star_bg(current_pixel, img[left_dot[1], left_dot[0] + stable_offsets[0]]):
+                star_bg_start = width_offset
+            stable_offsets.append(width_offset)
+            prev_stable_pixel = img[left_dot[1],
+                                    left_dot[0] + width_offset]
+    if star_bg_start > 0:
+        start_pixel = img[left_dot[1], left_dot[0] + star_bg_start]
+        star_bg_offset = 0
+        while 10 > get_pixel_diff(start_pixel, img[left_dot[1], left_dot[0] + star_bg_start + star_bg_offset]):
+            star_bg_offset += 1
+        stars = round((star_bg_offset - 2) / 10)
+    return stable_offsets, stars, has_gold_border
+
+
+def run(func, img):
+    # an exception is an answer too, both versions have to raise the same one
+    try:
+        return func(img)
+    except Exception as e:
+        return type(e).__name__
+
+
+def scan_player_row_or_none(img, player_number):
+    # analyse_rows gives None for the rows the scalar scanner raised on
+    try:
+        return scan_player_row(img, player_number)
+    except (ZeroDivisionError, IndexError):
+        return None
+
+
+def scalar_analyse_rows(img):
+    return [scan_player_row_or_none(img, player_number) for player_number in range(len(start.level_boxes_top_left))]
+
+
+def get_row_segments(rng):
+    """
+    Random (color, width) segments of a level box: mostly laid out like the
+    real ones, background, border, level and stars, the rest arbitrary
+    """
+    background = rng.integers(0, 256, 3)
+    if rng.random() < 0.3:
+        palette = list(start.border_colors) + list(star_backgrounds) + [gold, background]
+        return [(palette[rng.integers(len(palette))] if rng.random() < 0.7 else rng.integers(0, 256, 3),
+                 int(rng.integers(1, 14))) for _ in range(12)]
+    border = start.border_colors[rng.integers(len(start.border_colors))]
+    segments = [(background, int(rng.integers(1, 9)))]
+    if rng.random() < 0.3:
+        segments.append((gold, int(rng.integers(1, 3))))
+    segments += [(border, int(rng.integers(2, 5))), (rng.integers(0, 80, 3), int(rng.integers(20, 40)))]
+    if rng.random() < 0.5:
+        star_background = star_backgrounds[1] if border is start.border_colors[3] else star_backgrounds[0]
+        segments.append((star_background, 10 * int(rng.integers(1, 5)) + 2))
+    return segments + [(background, 60)]
+
+
+def make_synthetic_rows(rng):
+    """
+    A frame with every level box painted from get_row_segments
+    """
+    img = rng.integers(0, 256, (1440, 2560, 3), dtype=np.uint8)
+    for x, y in start.level_boxes_top_left:
+        offset = 0
+        for color, width in get_row_segments(rng):
+            img[y - 1: y + 17, x + offset: x + offset + width] = color
+            offset += width
+    return img
+
+
+def check_rows(name, img):
+    expected = run(scalar_analyse_rows, img)
+    actual = run(start.analyse_rows, img)
+    if expected != actual:
+        print(f"analyse_rows differs on {name}:\n  scalar     {expected}\n  vectorized {actual}")
+        return False
+    return True
+
+
+def make_synthetic_scoreboard(rng):
+    """
+    A frame with level boxes drawn like the game does, in segments wide
+    enough to survive scaling: background, a level box of the border color
+    with dark digits and a stars block. The gold border is left out, it is
+    too thin to keep its color when a frame is scaled down
+    """
+    img = rng.integers(0, 256, (1440, 2560, 3), dtype=np.uint8)
+    for x, y in start.level_boxes_top_left:
+        border = start.border_colors[rng.integers(len(start.border_colors))]
+        star_background = star_backgrounds[1] if border is start.border_colors[3] else star_backgrounds[0]
+        # never gray, gray has no hue for the gold border test, and never mostly red, so the
+        # blurred edge into a silver box does not look gold; far from the box colors
+        background = rng.permutation([int(rng.integers(0, 60)), int(rng.integers(90, 150)), int(rng.integers(200, 256))])
+        while background[2] == background.max() or min(
+                get_pixel_diff(background, color) for color in (border, star_background)) < 60:
+            background = rng.permutation(background)
+        img[y - 6: y + 23, x - 10: x + 160] = background
+        # the stars block starts well inside the width_to_check the scanner looks at
+        offset = int(rng.integers(8, 13))
+        width = int(rng.integers(30, 40))
+        img[y - 6: y + 23, x + offset: x + offset + width] = border
+        img[y + 3: y + 14, x + offset + 8: x + offset + width - 8] = rng.integers(0, 60, 3)
+        offset += width
+        if rng.random() < 0.5:
+            img[y - 6: y + 23, x + offset: x + offset + 10 * int(rng.integers(1, 5)) + 2] = star_background
+    return img
+
+
+def get_row_readings(img):
+    frame_layout = start.get_layout(img)
+    # the gold border only matters as the color it turns silver into
+    return [None if row is None else (row['color'], row['stars']) for row in start.scan_rows(img, frame_layout)]
+
+
+def check_scaled_rows(name, img):
+    ok = True
+    expected = get_row_readings(img)
+    for size in row_layout_sizes:
+        actual = get_row_readings(to_size(img, size))
+        if actual != expected:
+            print(f"scan_rows differs on {name} at {size[0]}x{size[1]}:\n  2560x1440 {expected}\n  scaled    {actual}")
+            ok = False
+    return ok
+
+
+def to_size(img, size):
+    """
+    The 2560x1440 frame as the game would show it at size, letterboxed the
+    way layouts.get_transform expects
+    """
+    scale, x_offset, y_offset = layouts.get_transform(*size)
+    frame = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+    hud = layouts.scale_image(img, (round(layouts.base_size[0] * scale), round(layouts.base_size[1] * scale)))
+    frame[y_offset: y_offset + hud.shape[0], x_offset: x_offset + hud.shape[1]] = hud
+    return frame
+
+
+def get_reference_score(frame, template):
+    crop = frame[template['y']: template['y'] + template['h'], template['x']: template['x'] + template['w']]
+    score = float(cv2.matchTemplate(crop, template['template'], cv2.TM_CCORR_NORMED, mask=template['mask'])[0, 0])
+    # a black crop has no norm, TemplateMatcher scores it 0
+    return score if np.isfinite(score) else 0.0
+
+
+def check_matcher(name, img):
+    ok = True
+    for size in layout_sizes:
+        frame = to_size(img, size)
+        start.get_layout(frame)
+        scores = start.result_matcher.scores(frame)
+        for result, template in start.result_matcher.templates.items():
+            expected = get_reference_score(frame, template)
+            if abs(scores[result] - expected) > score_tolerance:
+                print(f"{result} score differs on {name} at {size[0]}x{size[1]}: "
+                      f"cv2.matchTemplate {expected:.6f}, TemplateMatcher {scores[result]:.6f}")
+                ok = False
+    return ok
+
+
+def make_synthetic_results(rng):
+    """
+    Random frames with one of the result banners each
+    """
+    for name in ('victory', 'defeat', 'draw'):
+        img = rng.integers(0, 256, (1440, 2560, 3), dtype=np.uint8)
+        template = start.base_templates[name]
+        img[template['y']: template['y'] + template['h'], template['x']: template['x'] + template['w']] = template['template']
+        yield f'synthetic {name} frame', img
+
+
+def iter_fixtures(path):
+    if not path:
+        return
+    try:
+        packed = archive.open_dir(path)
+        names = archive.list_screenshots(path, packed)
+    except OSError:
+        return
+    for name in names:
+        img = archive.read_screenshot(path, name, packed)
+        if img is not None:
+            yield name, img
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the optimized recognition code to the original')
+    parser.add_argument('--fixtures', default='./scoreboards')
+    parser.add_argument('--synthetic', type=int, default=200, help='number of synthetic frames')
+    args = parser.parse_args()
+
+    checked = failed = 0
+    frames_checked = frames_failed = 0
+    rng = np.random.default_rng(0)
+    for name, img in iter_fixtures(args.fixtures):
+        # both checks work on 2560x1440 coordinates
+        img = layouts.to_base(img, start.get_layout(img))
+        frames_checked += 1
+        frames_failed += not check_matcher(name, img)
+        if name.startswith('scoreboard_result'):
+            continue
+        checked += 1
+        failed += not check_rows(name, img)
+    for name, img in make_synthetic_results(rng):
+        frames_checked += 1
+        frames_failed += not check_matcher(name, img)
+    for i in range(args.synthetic):
+        checked += 1
+        failed += not check_rows(f'synthetic frame {i}', make_synthetic_rows(rng))
+    scaled_checked = scaled_failed = 0
+    for i in range(args.synthetic // 10):
+        scaled_checked += 1
+        scaled_failed += not check_scaled_rows(f'synthetic scoreboard {i}', make_synthetic_scoreboard(rng))
+    print(f"analyse_rows: {checked - failed} of {checked} frames match")
+    print(f"scan_rows: {scaled_checked - scaled_failed} of {scaled_checked} scoreboards read the same "
+          f"at {', '.join(f'{width}x{height}' for width, height in row_layout_sizes)}")
+    print(f"TemplateMatcher: {frames_checked - frames_failed} of {frames_checked} frames match "
+          f"at {', '.join(f'{width}x{height}' for width, height in layout_sizes)}")
+    if failed or frames_failed or scaled_failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Helpers for deciding how much of a captured frame the main loop has to look at.
+"""
+
+import cv2
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+
+class FrameGate:
+    """
+    Compares a tiny grayscale signature of every frame with the signature of
+    the last processed frame, so unchanged frames (menus, loading screens,
+    AFK) skip template matching and recognition entirely
+    """
+
+    def __init__(self, size=(96, 54), mean_threshold=1.5, pixel_threshold=40, max_skipped=30):
+        self.size = size
+        # average difference over the whole signature, catches fades
+        self.mean_threshold = mean_threshold
+        # difference of a single signature pixel, catches small banners
+        self.pixel_threshold = pixel_threshold
+        # process a frame anyway after this many skipped in a row
+        self.max_skipped = max_skipped
+        self.signature = None
+        self.state = None
+        self.skipped_in_row = 0
+        self.skipped = 0
+        self.processed = 0
+
+    def get_signature(self, pil_image):
+        # downscale first so the full frame is read once and never copied
+        return np.asarray(pil_image.resize(self.size, Image.BOX).convert('L'), dtype=np.int16)
+
+    def has_changed(self, pil_image, state=None):
+        signature = self.get_signature(pil_image)
+        changed = (self.signature is None or state != self.state or
+                   self.skipped_in_row >= self.max_skipped)
+        if not changed:
+            diff = np.abs(signature - self.signature)
+            changed = diff.mean() > self.mean_threshold or diff.max() > self.pixel_threshold
+        if changed:
+            self.signature = signature
+            self.state = state
+            self.skipped_in_row = 0
+            self.processed += 1
+        else:
+            self.skipped_in_row += 1
+            self.skipped += 1
+        return changed
+
+    def reset(self):
+        self.signature = None
+        self.skipped_in_row = 0
+
+
+def get_union_rect(templates):
+    """
+    Smallest (left, top, right, bottom) box that holds all the templates
+    """
+    return (min(t['x'] for t in templates), min(t['y'] for t in templates),
+            max(t['x'] + t['w'] for t in templates), max(t['y'] + t['h'] for t in templates))
+
+
+def convert_region(pil_image, templates):
+    """
+    Converts only the part of the frame the templates need to a BGR array.
+    Returns the array and its (x, y) origin in the full frame
+    """
+    rect = get_union_rect(templates)
+    region = np.asarray(pil_image.crop(rect))
+    return cv2.cvtColor(region, cv2.COLOR_RGB2BGR), rect[:2]
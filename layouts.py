@@ -0,0 +1,140 @@
+"""
+Screen layouts for resolutions other than the 2560x1440 the templates and
+coordinates in start.py were made for.
+
+The game HUD is a centered 16:9 area scaled to the frame height (or width on
+frames narrower than 16:9), so every region is the base region scaled and
+shifted into that area. Scaled templates and masks are built once per layout
+and cached in `cache_dir`.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+base_size = (2560, 1440)
+cache_dir = './layout_cache'
+
+# known profiles, any other frame size gets a layout named after its size
+profiles = {
+    (1920, 1080): '1080p',
+    (2560, 1440): '1440p',
+    (3840, 2160): '4k',
+    (2560, 1080): 'ultrawide-1080p',
+    (3440, 1440): 'ultrawide-1440p',
+    (5120, 1440): 'super-ultrawide-1440p',
+}
+
+
+def get_profile_name(width, height):
+    return profiles.get((width, height), f'{width}x{height}')
+
+
+def get_transform(width, height):
+    """
+    Returns (scale, x_offset, y_offset) of the 16:9 HUD area inside the frame
+    """
+    scale = min(width / base_size[0], height / base_size[1])
+    return (scale, round((width - base_size[0] * scale) / 2),
+            round((height - base_size[1] * scale) / 2))
+
+
+def scale_point(point, transform):
+    scale, x_offset, y_offset = transform
+    return round(point[0] * scale) + x_offset, round(point[1] * scale) + y_offset
+
+
+def scale_image(image, size, nearest=False):
+    if image is None or image.shape[1::-1] == size:
+        return image
+    if nearest:
+        interpolation = cv2.INTER_NEAREST
+    elif size[0] < image.shape[1]:
+        interpolation = cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_CUBIC
+    return cv2.resize(image, size, interpolation=interpolation)
+
+
+def get_scaled_size(image, scale):
+    # templates can be smaller than their search region, so they scale by their own size
+    if image is None:
+        return None
+    return (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+
+
+def scale_template(template, transform):
+    scale, x_offset, y_offset = transform
+    scaled = dict(template)
+    scaled['x'] = round(template['x'] * scale) + x_offset
+    scaled['y'] = round(template['y'] * scale) + y_offset
+    scaled['w'] = max(1, round(template['w'] * scale))
+    scaled['h'] = max(1, round(template['h'] * scale))
+    scaled['template'] = scale_image(template['template'], get_scaled_size(template['template'], scale))
+    # masks stay binary
+    scaled['mask'] = scale_image(template['mask'], get_scaled_size(template['mask'], scale), nearest=True)
+    return scaled
+
+
+def get_templates_digest(templates):
+    digest = hashlib.blake2b(digest_size=8)
+    for name in sorted(templates):
+        for key in ('template', 'mask'):
+            image = templates[name][key]
+            digest.update(f'{name} {key} {None if image is None else image.shape}'.encode('utf-8'))
+            if image is not None:
+                digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def load_layout(templates, width, height):
+    """
+    Returns the layout for a frame size: its name, transform and the base
+    templates (a dict of name -> template) scaled into it, from the disk
+    cache when the base templates have not changed since it was built
+    """
+    transform = get_transform(width, height)
+    layout = {'name': get_profile_name(width, height), 'size': (width, height),
+              'transform': transform, 'templates': {}}
+    if (width, height) == base_size:
+        layout['templates'] = dict(templates)
+        return layout
+
+    cache_file = os.path.join(cache_dir, f"{layout['name']}-{get_templates_digest(templates)}.npz")
+    cached = {}
+    if os.path.isfile(cache_file):
+        with np.load(cache_file) as data:
+            cached = dict(data)
+
+    arrays = {}
+    for name, template in templates.items():
+        scaled = scale_template(dict(template, template=None, mask=None), transform)
+        for key in ('template', 'mask'):
+            cache_key = f'{name}.{key}'
+            if template[key] is None:
+                continue
+            if cache_key not in cached:
+                cached[cache_key] = scale_image(template[key], get_scaled_size(template[key], transform[0]),
+                                                nearest=key == 'mask')
+            scaled[key] = arrays[cache_key] = cached[cache_key]
+        layout['templates'][name] = scaled
+
+    if not os.path.isfile(cache_file):
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        np.savez(cache_file, **arrays)
+    return layout
+
+
+def to_base(img, layout):
+    """
+    Cuts the HUD area out of a full frame and scales it to the base size, so
+    the row scanner and glyph bank made for 2560x1440 can read it
+    """
+    if layout['size'] == base_size:
+        return img
+    scale, x_offset, y_offset = layout['transform']
+    width, height = round(base_size[0] * scale), round(base_size[1] * scale)
+    return scale_image(img[y_offset: y_offset + height, x_offset: x_offset + width], base_size)
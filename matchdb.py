@@ -0,0 +1,207 @@
+"""
+SQLite database of recorded matches, for stats without loading the json files.
+
+    python matchdb.py import [results.jsonl]
+    python matchdb.py level-diff [bucket_size] [from_date] [to_date]
+    python matchdb.py color [from_date] [to_date]
+    python matchdb.py date [day|week|month]
+
+Dates are `YYYY-MM-DD`. start.py adds every new match to the database when
+`use_match_db` is enabled.
+"""
+
+import re
+import sqlite3
+import sys
+from os.path import basename
+
+import storage
+
+db_file = 'matches.db'
+# stored level_bucket is level_diff // level_bucket_size
+level_bucket_size = 100
+
+schema = '''
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY,
+    time TEXT,
+    result TEXT,
+    scoreboard_file TEXT UNIQUE,
+    result_file TEXT,
+    my_team_level REAL,
+    enemy_team_level REAL,
+    level_diff REAL,
+    level_bucket INTEGER
+);
+CREATE TABLE IF NOT EXISTS players (
+    match_id INTEGER REFERENCES matches(id) ON DELETE CASCADE,
+    slot INTEGER,
+    team TEXT,
+    level TEXT,
+    level_base INTEGER,
+    color TEXT,
+    stars INTEGER,
+    total_level INTEGER,
+    -- copy of matches.result so win rates by color only read the index
+    result TEXT,
+    PRIMARY KEY (match_id, slot)
+);
+CREATE INDEX IF NOT EXISTS matches_time ON matches(time);
+CREATE INDEX IF NOT EXISTS matches_result ON matches(result);
+CREATE INDEX IF NOT EXISTS matches_level_bucket ON matches(level_bucket, result);
+CREATE INDEX IF NOT EXISTS players_color_match ON players(team, color, result, match_id);
+'''
+
+
+def connect(path=db_file):
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.executescript(schema)
+    return conn
+
+
+def get_player_level(player):
+    # same as start.get_player_level
+    return player['level_base'] + int(player['level']) + player['stars'] * 100
+
+
+def get_match_time(scoreboard_file):
+    found = re.search(r'(\d{4}-\d\d-\d\d)-(\d\d)-(\d\d)-(\d\d)', scoreboard_file)
+    if found is None:
+        return None
+    return '{} {}:{}:{}'.format(*found.groups())
+
+
+def add_match(conn, match):
+    """
+    Inserts (or replaces) one entry of results.json
+    """
+    levels = [get_player_level(player) for player in match['players']]
+    my_team_level = sum(levels[:6]) / 6
+    enemy_team_level = sum(levels[6:]) / 6
+    level_diff = my_team_level - enemy_team_level
+    scoreboard_file = basename(match['scoreboard_file'])
+    conn.execute('DELETE FROM matches WHERE scoreboard_file = ?', (scoreboard_file,))
+    cursor = conn.execute(
+        'INSERT INTO matches (time, result, scoreboard_file, result_file, my_team_level, '
+        'enemy_team_level, level_diff, level_bucket) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (get_match_time(scoreboard_file), match['result'], scoreboard_file, basename(match['result_file']),
+         my_team_level, enemy_team_level, level_diff, int(level_diff // level_bucket_size)))
+    conn.executemany(
+        'INSERT INTO players VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        [(cursor.lastrowid, slot, 'my' if slot < 6 else 'enemy', player['level'], player['level_base'],
+          player['color'], player['stars'], level, match['result']) for slot, (player, level) in enumerate(zip(match['players'], levels))])
+    return cursor.lastrowid
+
+
+def import_matches(conn, path='results.jsonl'):
+    """
+    Adds every entry of a results file, skipping the ones that can't be read.
+    Returns (imported, skipped)
+    """
+    entries = storage.iter_matches(path) if path.endswith('.jsonl') else storage.iter_array(path)
+    count = skipped = 0
+    with conn:
+        for match in entries:
+            # a bad entry only undoes its own rows, not the whole import
+            conn.execute('SAVEPOINT entry')
+            try:
+                add_match(conn, match)
+            except (KeyError, TypeError, ValueError) as e:
+                conn.execute('ROLLBACK TO entry')
+                print(f"Warning: skipping {match.get('scoreboard_file') if isinstance(match, dict) else match}: {e!r}")
+                skipped += 1
+            else:
+                count += 1
+            conn.execute('RELEASE entry')
+    return count, skipped
+
+
+def get_date_filter(from_date=None, to_date=None):
+    conditions, args = [], []
+    if from_date:
+        conditions.append('m.time >= ?')
+        args.append(from_date)
+    if to_date:
+        # to_date is inclusive
+        conditions.append('m.time < date(?, \'+1 day\')')
+        args.append(to_date)
+    return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), args
+
+
+win_rate_columns = '''COUNT(*) AS matches,
+    SUM(m.result = 'W') AS wins,
+    SUM(m.result = 'L') AS losses,
+    SUM(m.result = 'D') AS draws,
+    ROUND(100.0 * SUM(m.result = 'W') / COUNT(*), 1) AS win_rate'''
+
+
+# a team can have several players of a color, a match is counted once for them
+color_win_rate_columns = '''COUNT(DISTINCT p.match_id) AS matches,
+    COUNT(DISTINCT CASE WHEN p.result = 'W' THEN p.match_id END) AS wins,
+    COUNT(DISTINCT CASE WHEN p.result = 'L' THEN p.match_id END) AS losses,
+    COUNT(DISTINCT CASE WHEN p.result = 'D' THEN p.match_id END) AS draws,
+    ROUND(100.0 * COUNT(DISTINCT CASE WHEN p.result = 'W' THEN p.match_id END)
+        / COUNT(DISTINCT p.match_id), 1) AS win_rate'''
+
+
+def win_rate_by_level_diff(conn, bucket_size=level_bucket_size, from_date=None, to_date=None):
+    where, args = get_date_filter(from_date, to_date)
+    if int(bucket_size) == level_bucket_size:
+        bucket = 'm.level_bucket'
+    else:
+        # CAST truncates towards zero, shift by a large multiple to floor negative diffs
+        bucket = '(CAST(m.level_diff / ? + 100000 AS INTEGER) - 100000)'
+        args = [float(bucket_size)] + args
+    return conn.execute(
+        f'SELECT {bucket} * {int(bucket_size)} AS level_diff_from, {win_rate_columns} '
+        f'FROM matches m{where} GROUP BY 1 ORDER BY 1', args).fetchall()
+
+
+def win_rate_by_color(conn, from_date=None, to_date=None):
+    where, args = get_date_filter(from_date, to_date)
+    # without dates the players index covers the whole query
+    join = ' JOIN matches m ON m.id = p.match_id' if where else ''
+    return conn.execute(
+        f'SELECT p.team, p.color, {color_win_rate_columns} FROM players p{join}{where} '
+        'GROUP BY p.team, p.color ORDER BY p.team, p.color', args).fetchall()
+
+
+def win_rate_by_date(conn, period='day', from_date=None, to_date=None):
+    formats = {'day': '%Y-%m-%d', 'week': '%Y-W%W', 'month': '%Y-%m'}
+    where, args = get_date_filter(from_date, to_date)
+    return conn.execute(
+        f'SELECT strftime(?, m.time) AS period, {win_rate_columns} FROM matches m{where} GROUP BY 1 ORDER BY 1',
+        [formats[period]] + args).fetchall()
+
+
+def print_rows(cursor_rows, header):
+    print('\t'.join(header))
+    for row in cursor_rows:
+        print('\t'.join('' if value is None else str(value) for value in row))
+
+
+def main():
+    args = sys.argv[1:]
+    if not args:
+        sys.stderr.write(__doc__)
+        exit(2)
+    conn = connect()
+    command, args = args[0], args[1:]
+    stats_header = ['matches', 'wins', 'losses', 'draws', 'win_rate']
+    if command == 'import':
+        count, skipped = import_matches(conn, *args)
+        print(f"Imported {count} matches, skipped {skipped} bad entries")
+    elif command == 'level-diff':
+        print_rows(win_rate_by_level_diff(conn, *args), ['level_diff_from'] + stats_header)
+    elif command == 'color':
+        print_rows(win_rate_by_color(conn, *args), ['team', 'color'] + stats_header)
+    elif command == 'date':
+        print_rows(win_rate_by_date(conn, *args), ['period'] + stats_header)
+    else:
+        sys.stderr.write(__doc__)
+        exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Template scores for fixed-position checks.
+
+When the crop has exactly the size of the template, TM_CCORR_NORMED has a
+single value:
+
+    sum(I * T * M^2) / sqrt(sum((T * M)^2) * sum((I * M)^2))
+
+The weighted template T * M^2, the squared mask and the template norm only
+depend on the template, so they are computed once and a score is two dot
+products over the crop, without the per-call normalization and masking of
+cv2.matchTemplate.
+"""
+
+import numpy as np
+
+
+class TemplateMatcher:
+    """
+    Scores named templates (dicts with x, y, w, h, template and mask, the
+    template as big as its region) against their regions of a frame
+    """
+
+    def __init__(self, templates):
+        self.templates = dict(templates)
+        for name, template in self.templates.items():
+            if template['template'].shape[:2] != (template['h'], template['w']):
+                raise ValueError(f"{name} template is not the size of its region, use cv2.matchTemplate")
+        # filled in on the first score of a template, keeps startup and layout switches cheap
+        self.weights = {}
+        self.mask_weights = {}
+        self.norms = {}
+
+    def prepare(self, name):
+        template = self.templates[name]
+        values = template['template'].astype(np.float32)
+        mask = None if template['mask'] is None else template['mask'].astype(np.float32)
+        masked = values if mask is None else values * mask
+        self.weights[name] = (masked if mask is None else masked * mask).ravel()
+        self.mask_weights[name] = None if mask is None else (mask * mask).ravel()
+        self.norms[name] = float(np.sqrt(np.square(masked, dtype=np.float64).sum()))
+
+    def scores(self, image, origin=(0, 0), names=None):
+        """
+        Returns {name: score} for the given templates, all of them by default.
+        origin is where image starts in the full frame
+        """
+        scores = {}
+        for name in self.templates if names is None else names:
+            if name not in self.norms:
+                self.prepare(name)
+            template = self.templates[name]
+            x = template['x'] - origin[0]
+            y = template['y'] - origin[1]
+            crop = image[y: y + template['h'], x: x + template['w']]
+            values = crop.astype(np.float32).ravel()
+            mask_weights = self.mask_weights[name]
+            energy = float(values @ values if mask_weights is None else (values * values) @ mask_weights)
+            denominator = self.norms[name] * np.sqrt(energy)
+            scores[name] = float(values @ self.weights[name]) / denominator if denominator else 0.0
+        return scores
@@ -0,0 +1,180 @@
+"""
+Lightweight timing and counters for the main loop and recognition.
+
+    with metrics.stage('capture'):
+        ...
+    metrics.count('frames')
+
+Nothing is recorded until enable() is called; disabled stages are a shared
+no-op context manager. When enabled, the stats are written to a JSON file
+every few seconds and can be served as Prometheus text on localhost.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# histogram bucket upper bounds in milliseconds
+buckets = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# latencies kept per stage for the rolling percentiles
+window = 500
+
+enabled = False
+stats_file = None
+lock = threading.Lock()
+stages = {}
+counters = {}
+started = time.time()
+
+
+class Stage:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=window)
+
+    def add(self, ms):
+        index = 0
+        while index < len(buckets) and ms > buckets[index]:
+            index += 1
+        self.bucket_counts[index] += 1
+        self.count += 1
+        self.total += ms
+        self.recent.append(ms)
+
+    def summary(self):
+        recent = sorted(self.recent)
+
+        def percentile(p):
+            return recent[min(len(recent) - 1, int(p * len(recent)))] if recent else 0
+
+        return {'count': self.count, 'mean_ms': self.total / self.count if self.count else 0,
+                'p50_ms': percentile(0.5), 'p95_ms': percentile(0.95), 'p99_ms': percentile(0.99),
+                'max_ms': recent[-1] if recent else 0}
+
+
+class Timer:
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, (time.perf_counter() - self.started) * 1000)
+        return False
+
+
+class NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+noop = NoopTimer()
+
+
+def stage(name):
+    return Timer(name) if enabled else noop
+
+
+def observe(name, ms):
+    with lock:
+        if name not in stages:
+            stages[name] = Stage()
+        stages[name].add(ms)
+
+
+def count(name, value=1):
+    if enabled:
+        with lock:
+            counters[name] = counters.get(name, 0) + value
+
+
+def snapshot():
+    with lock:
+        return {'uptime_s': time.time() - started, 'counters': dict(counters),
+                'stages': {name: s.summary() for name, s in stages.items()}}
+
+
+def to_prometheus():
+    lines = []
+    with lock:
+        for name, value in sorted(counters.items()):
+            lines.append(f'# TYPE owtracker_{name}_total counter')
+            lines.append(f'owtracker_{name}_total {value}')
+        lines.append('# TYPE owtracker_stage_duration_ms histogram')
+        for name, s in sorted(stages.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ('+Inf',), s.bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'owtracker_stage_duration_ms_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'owtracker_stage_duration_ms_sum{{stage="{name}"}} {s.total}')
+            lines.append(f'owtracker_stage_duration_ms_count{{stage="{name}"}} {s.count}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_stats(path):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(snapshot(), file, indent=1)
+    os.replace(temp_path, path)
+
+
+def serve(port):
+    """
+    Serves the stats as Prometheus text at http://127.0.0.1:port/metrics
+    """
+    # only imported when the endpoint is used
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def enable(path=None, stats_interval=10, port=None):
+    """
+    Starts recording. Writes stats to path every stats_interval seconds and
+    serves http://127.0.0.1:port/metrics if a port is given
+    """
+    global enabled, stats_file
+    enabled = True
+    stats_file = path
+    if path:
+        def write_periodically():
+            while enabled:
+                time.sleep(stats_interval)
+                write_stats(path)
+        threading.Thread(target=write_periodically, daemon=True).start()
+    if port:
+        return serve(port)
+    return None
+
+
+def flush():
+    if enabled and stats_file:
+        write_stats(stats_file)
@@ -0,0 +1,143 @@
+"""
+Background threads for the main loop, so capturing does not wait for
+recognition or for files to be written.
+
+CaptureThread runs the capture loop and hands frames to the processing loop
+through a bounded queue. Writer runs PNG archiving and result persistence on
+one thread, in the order they were submitted, and close() waits until
+everything queued is written. InlineWriter and InlineExecutor have the same
+interface but run everything right away, for the single-threaded loop.
+"""
+
+import queue
+import sys
+import threading
+import traceback
+from concurrent.futures import Future
+
+import metrics
+
+
+class CaptureThread(threading.Thread):
+    """
+    Iterates frames (a generator of captured frames) on its own thread. When
+    drop is set and the processing loop falls behind, the oldest queued frame
+    is dropped so the newest screen is always looked at; otherwise the
+    capture waits for room in the queue. Iterating the thread yields the
+    frames and re-raises an error the capture ended with
+    """
+
+    def __init__(self, frames, size=4, drop=True):
+        super().__init__(name='capture', daemon=True)
+        self.frames = frames
+        self.queue = queue.Queue(size)
+        self.drop = drop
+        self.dropped = 0
+        self.error = None
+        self.stopping = threading.Event()
+
+    def put(self, item):
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if not self.drop:
+                    continue
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                    metrics.count('frames_dropped')
+                except queue.Empty:
+                    pass
+
+    def run(self):
+        try:
+            for frame in self.frames:
+                if self.stopping.is_set():
+                    break
+                self.put(frame)
+        except Exception as err:
+            self.error = err
+        finally:
+            self.put(None)
+
+    def stop(self):
+        self.stopping.set()
+
+    def __iter__(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            yield frame
+        if self.error is not None:
+            raise self.error
+
+
+class Writer(threading.Thread):
+    """
+    Runs submitted jobs one at a time in submission order. A failed job is
+    printed and counted, the jobs after it still run. submit() blocks once
+    size jobs are waiting, so a slow disk slows the loop down instead of
+    piling up frames in memory
+    """
+
+    def __init__(self, size=32):
+        super().__init__(name='writer', daemon=True)
+        self.jobs = queue.Queue(size)
+        self.failed = 0
+
+    def submit(self, func, *args):
+        self.jobs.put((func, args))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    break
+                func, args = job
+                func(*args)
+            except Exception:
+                self.failed += 1
+                metrics.count('errors')
+                traceback.print_exc(file=sys.stdout)
+            finally:
+                self.jobs.task_done()
+
+    def flush(self):
+        self.jobs.join()
+
+    def close(self):
+        if self.is_alive():
+            self.jobs.put(None)
+            self.join()
+
+
+class InlineWriter:
+    def submit(self, func, *args):
+        func(*args)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class InlineExecutor:
+    """
+    Runs a submitted call right away and returns its finished future
+    """
+
+    def submit(self, func, *args):
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as err:
+            future.set_exception(err)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
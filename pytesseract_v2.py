@@ -4,21 +4,29 @@
 Python-tesseract. For more information: https://github.com/madmaze/pytesseract
 """
 
+import dbm
+import hashlib
+import multiprocessing
 import os
+import queue
+import re
+import shelve
 import shlex
 import string
 import subprocess
 import sys
 import tempfile
+import time
+from bisect import bisect_right
+from collections import OrderedDict
 from contextlib import contextmanager
 from csv import QUOTE_NONE
-from distutils.version import LooseVersion
 from functools import wraps
 from glob import iglob
 from io import BytesIO
 from os.path import normcase, normpath, realpath
 from pkgutil import find_loader
-from threading import Timer
+from threading import Lock, Timer
 
 import cv2
 
@@ -29,11 +37,13 @@ except ImportError:
 
 numpy_installed = find_loader('numpy') is not None
 if numpy_installed:
+    import numpy as np
     from numpy import ndarray
 
+# pandas is only imported for Output.DATAFRAME, it takes longer to import than everything else here
 pandas_installed = find_loader('pandas') is not None
-if pandas_installed:
-    import pandas as pd
+
+tesserocr_installed = find_loader('tesserocr') is not None
 
 # CHANGE THIS IF TESSERACT IS NOT IN YOUR PATH, OR IS NAMED DIFFERENTLY
 tesseract_cmd = 'tesseract'
@@ -42,6 +52,9 @@ SUPPORTED_FORMATS = {
     'JPEG', 'PNG', 'PBM', 'PGM', 'PPM', 'TIFF', 'BMP', 'GIF'
 }
 
+TSV_HEADER = ('level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\t'
+              'left\ttop\twidth\theight\tconf\ttext\n')
+
 OSD_KEYS = {
     'Page number': ('page_num', int),
     'Orientation in degrees': ('orientation', int),
@@ -85,6 +98,13 @@ class TSVNotSupported(EnvironmentError):
         )
 
 
+class TesserocrNotSupported(EnvironmentError):
+    def __init__(self):
+        super(TesserocrNotSupported, self).__init__(
+            'Missing tesserocr package, required for the worker pool'
+        )
+
+
 def kill(process, code):
     process.kill()
     process.returncode = code
@@ -164,6 +184,38 @@ def prepare(image):
     return image, extension
 
 
+def encode_image(image):
+    """
+    Returns the bytes to send to tesseract over stdin. Arrays become binary
+    PGM (one channel) or PPM (BGR, as from cv2): a short header and the raw
+    pixels, nothing to compress on our side or decode on tesseract's
+    """
+    if isinstance(image, str):
+        with open(image, 'rb') as f:
+            return f.read()
+
+    if not (numpy_installed and isinstance(image, ndarray)):
+        image, _ = prepare(image)
+        output = BytesIO()
+        image.save(output, format='PPM')
+        return output.getvalue()
+
+    if image.dtype != np.uint8:
+        return cv2.imencode('.bmp', image)[1].tobytes()
+    if image.ndim == 3 and image.shape[2] == 1:
+        image = image[:, :, 0]
+    if image.ndim == 2:
+        magic = b'P5'
+    else:
+        magic = b'P6'
+        if image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGB)
+        else:
+            image = image[:, :, ::-1]
+    header = b'%s\n%d %d\n255\n' % (magic, image.shape[1], image.shape[0])
+    return header + np.ascontiguousarray(image).tobytes()
+
+
 def save_image(image):
     with tempfile.NamedTemporaryFile(prefix='tess_', delete=False) as f:
         temp_name = f.name
@@ -256,19 +308,26 @@ def run_tesseract_v2(input_data,
 
     try:
         proc = subprocess.Popen(cmd_args, **subprocess_args())
-        proc.stdin.write(input_data)
     except OSError:
         raise TesseractNotFoundError()
 
-    with timeout_manager(proc, timeout) as error_string:
-        if proc.returncode:
-            print(proc.returncode)
-            print(error_string)
-            raise TesseractError(proc.returncode, get_errors(error_string.decode("utf-8")))
-
-    text = proc.communicate()[0]
-    return text
+    timer = None
+    timeout_code = -1
+    if timeout:
+        timer = Timer(timeout, kill, [proc, timeout_code])
+        timer.start()
+    try:
+        # input and output go through the pipes in one go, nothing touches the disk
+        output, error_string = proc.communicate(input_data)
+    finally:
+        if timer is not None:
+            timer.cancel()
 
+    if timer is not None and proc.returncode is timeout_code and not error_string:
+        raise RuntimeError('Tesseract process timeout')
+    if proc.returncode:
+        raise TesseractError(proc.returncode, get_errors(error_string))
+    return output
 
 
 def run_and_get_output_v1(image,
@@ -325,6 +384,338 @@ def run_and_get_output_v2(image,
         return result.decode('utf-8').strip()
 
 
+def parse_config(config):
+    """
+    Splits a command line config into (psm, oem, variables) for the API
+    """
+    psm, oem, variables = None, None, {}
+    args = shlex.split(config)
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in {'--psm', '-psm'} and i + 1 < len(args):
+            psm = int(args[i + 1])
+            i += 1
+        elif arg == '--oem' and i + 1 < len(args):
+            oem = int(args[i + 1])
+            i += 1
+        elif arg == '-c' and i + 1 < len(args):
+            key, _, value = args[i + 1].partition('=')
+            variables[key] = value
+            i += 1
+        i += 1
+    return psm, oem, variables
+
+
+def pool_worker_loop(conn):
+    """
+    Runs in a child process: keeps one warm tesserocr API per (lang, config)
+    and answers OCR requests coming over the pipe until it gets None
+    """
+    import tesserocr
+
+    apis = {}
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            if message == 'ping':
+                conn.send('pong')
+                continue
+            image, lang, config, extension = message
+            try:
+                api = apis.get((lang, config))
+                if api is None:
+                    psm, oem, variables = parse_config(config)
+                    api = tesserocr.PyTessBaseAPI(
+                        lang=lang or 'eng',
+                        psm=tesserocr.PSM.AUTO if psm is None else psm,
+                        oem=tesserocr.OEM.DEFAULT if oem is None else oem)
+                    for key, value in variables.items():
+                        api.SetVariable(key, value)
+                    apis[(lang, config)] = api
+                api.SetImage(Image.fromarray(image))
+                if extension == 'tsv':
+                    conn.send(('ok', TSV_HEADER + api.GetTSVText(0)))
+                else:
+                    conn.send(('ok', api.GetUTF8Text()))
+            except Exception as e:
+                conn.send(('error', str(e)))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        for api in apis.values():
+            api.End()
+        conn.close()
+
+
+class TesseractWorker:
+    """
+    Long-lived child process with the language data already loaded
+    """
+
+    def __init__(self):
+        self.process = None
+        self.conn = None
+        self.jobs = 0
+        self.start()
+
+    def start(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=pool_worker_loop, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.jobs = 0
+        self.last_used = time.monotonic()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def is_healthy(self, timeout=5):
+        if not self.process.is_alive():
+            return False
+        try:
+            self.conn.send('ping')
+            return self.conn.poll(timeout) and self.conn.recv() == 'pong'
+        except (OSError, EOFError):
+            return False
+
+    def run(self, image, lang=None, config='', extension='txt', timeout=0):
+        try:
+            self.conn.send((image, lang, config, extension))
+            if not self.conn.poll(timeout or None):
+                self.restart()
+                raise RuntimeError('Tesseract process timeout')
+            status, payload = self.conn.recv()
+        except (OSError, EOFError):
+            self.restart()
+            raise TesseractError(-1, 'Tesseract worker died')
+        self.jobs += 1
+        self.last_used = time.monotonic()
+        if status == 'error':
+            raise TesseractError(-1, payload)
+        return payload
+
+
+class TesseractPool:
+    """
+    Pool of warm Tesseract workers. Workers are recycled after max_jobs
+    requests, when a request takes longer than timeout seconds, or when
+    they fail the health check made before using a worker that was idle
+    for health_interval seconds.
+    A worker only runs one request at a time, so size is the number of
+    threads reading at once: one unless recognition_workers is set
+    """
+
+    def __init__(self, size=1, max_jobs=1000, timeout=10, health_interval=30):
+        self.size = size or 1
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.health_interval = health_interval
+        self.idle = queue.Queue()
+        for _ in range(self.size):
+            self.idle.put(TesseractWorker())
+
+    def run(self, image, lang=None, config='', extension='txt', timeout=0):
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        worker = self.idle.get()
+        try:
+            if worker.jobs >= self.max_jobs or not worker.process.is_alive():
+                worker.restart()
+            elif time.monotonic() - worker.last_used > self.health_interval:
+                self.restart_unhealthy(worker)
+            return worker.run(image, lang, config, extension,
+                              timeout or self.timeout).strip()
+        finally:
+            self.idle.put(worker)
+
+    def image_to_string(self, image, lang=None, config='', timeout=0):
+        return self.run(image, lang, config, 'txt', timeout)
+
+    def image_to_data(self, image, lang=None, config='', timeout=0):
+        return self.run(image, lang, config, 'tsv', timeout)
+
+    def check_health(self):
+        """
+        Restarts unresponsive workers, returns how many were restarted
+        """
+        restarted = 0
+        for _ in range(self.size):
+            worker = self.idle.get()
+            try:
+                restarted += self.restart_unhealthy(worker)
+            finally:
+                self.idle.put(worker)
+        return restarted
+
+    def restart_unhealthy(self, worker):
+        if worker.is_healthy():
+            worker.last_used = time.monotonic()
+            return False
+        worker.restart()
+        return True
+
+    def close(self):
+        for _ in range(self.size):
+            self.idle.get().stop()
+
+
+pool = None
+
+
+def start_pool(size=1, max_jobs=1000, timeout=10):
+    """
+    Routes image_to_string through a pool of warm workers instead of
+    starting a new tesseract process for every image
+    """
+    global pool
+    if not tesserocr_installed:
+        raise TesserocrNotSupported()
+    stop_pool()
+    pool = TesseractPool(size, max_jobs, timeout)
+    return pool
+
+
+def stop_pool():
+    global pool
+    if pool is not None:
+        pool.close()
+        pool = None
+
+
+class OcrCache:
+    """
+    OCR results keyed by a hash of the image bytes and the config, with a
+    bounded in-memory LRU tier and an optional shelve file on disk.
+    A read-only cache collects its new results in new_entries so that
+    several processes can share one file and let a single one write it
+    """
+
+    def __init__(self, max_size=4096, path=None, read_only=False):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.new_entries = {}
+        self.read_only = read_only
+        self.disk = None
+        if path:
+            try:
+                self.disk = shelve.open(path, flag='r' if read_only else 'c')
+            except dbm.error:
+                # nothing cached on disk yet
+                pass
+        self.lock = Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(image, lang, config):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update('{} {} {} {}'.format(
+            image.shape, image.dtype, lang, config).encode('utf-8'))
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            text = self.entries.get(key)
+            if text is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return text
+            if self.disk is not None:
+                text = self.disk.get(key)
+                if text is not None:
+                    self.disk_hits += 1
+                    self.remember(key, text)
+                    return text
+            self.misses += 1
+            return None
+
+    def put(self, key, text):
+        with self.lock:
+            self.remember(key, text)
+            if self.read_only:
+                self.new_entries[key] = text
+            elif self.disk is not None:
+                self.disk[key] = text
+
+    def update(self, entries):
+        for key, text in entries.items():
+            self.put(key, text)
+
+    def remember(self, key, text):
+        self.entries[key] = text
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                'misses': self.misses, 'size': len(self.entries)}
+
+    def close(self):
+        with self.lock:
+            if self.disk is not None:
+                self.disk.close()
+                self.disk = None
+
+
+cache = None
+
+
+def enable_cache(max_size=4096, path=None, read_only=False):
+    """
+    Puts an OcrCache in front of image_to_string, images_to_strings and
+    their confidence variants, pass a path to keep the results between runs
+    """
+    global cache
+    disable_cache()
+    cache = OcrCache(max_size, path, read_only)
+    return cache
+
+
+def disable_cache():
+    global cache
+    if cache is not None:
+        cache.close()
+        cache = None
+
+
+def get_text(image, lang=None, config='', nice=0, timeout=0):
+    key = None
+    if cache is not None:
+        key = cache.make_key(image, lang, config)
+        text = cache.get(key)
+        if text is not None:
+            return text
+
+    if pool is not None:
+        text = pool.image_to_string(image, lang, config, timeout)
+    else:
+        text = run_and_get_output_v2(encode_image(image), 'txt', lang, config, nice, timeout)
+
+    if key is not None:
+        cache.put(key, text)
+    return text
+
+
 def file_to_dict(tsv, cell_delimiter, str_col_idx):
     result = {}
     rows = [row.split(cell_delimiter) for row in tsv.split('\n')]
@@ -382,6 +773,9 @@ def get_tesseract_version():
     """
     Returns LooseVersion object of the Tesseract version
     """
+    # distutils pulls in setuptools, only import it when the version is asked for
+    from distutils.version import LooseVersion
+
     try:
         return str(LooseVersion(
             subprocess.check_output(
@@ -419,8 +813,15 @@ def image_to_string(image,
     """
     Returns the result of a Tesseract OCR run on the provided image to string
     """
-    _, bmp = cv2.imencode('.bmp', image)
-    args = [bmp, 'txt', lang, config, nice, timeout]
+    if pool is not None or cache is not None:
+        text = get_text(image, lang, config, nice, timeout)
+        return {
+            Output.BYTES: lambda: text.encode('utf-8'),
+            Output.DICT: lambda: {'text': text},
+            Output.STRING: lambda: text,
+        }[output_type]()
+
+    args = [encode_image(image), 'txt', lang, config, nice, timeout]
 
     return {
         Output.BYTES: lambda: run_and_get_output_v2(*(args + [True])),
@@ -446,6 +847,23 @@ def image_to_pdf_or_hocr_v1(image,
     return run_and_get_output_v1(*args)
 
 
+def image_to_pdf_or_hocr(image,
+                         lang=None,
+                         config='',
+                         nice=0,
+                         extension='pdf',
+                         timeout=0):
+    """
+    Returns the result of a Tesseract OCR run on the provided image to pdf/hocr
+    """
+
+    if extension not in {'pdf', 'hocr'}:
+        raise ValueError('Unsupported extension: {}'.format(extension))
+    args = [encode_image(image), extension, lang, config, nice, timeout, True]
+
+    return run_and_get_output_v2(*args)
+
+
 def image_to_boxes_v1(image,
                    lang=None,
                    config='',
@@ -478,8 +896,7 @@ def image_to_boxes(image,
     Returns string containing recognized characters and their box boundaries
     """
     config += ' batch.nochop makebox'
-    _, bmp = cv2.imencode('.bmp', image)
-    args = [bmp, 'box', lang, config, nice, timeout]
+    args = [encode_image(image), 'box', lang, config, nice, timeout]
 
     return {
         Output.BYTES: lambda: run_and_get_output_v2(*(args + [True])),
@@ -494,6 +911,7 @@ def image_to_boxes(image,
 def get_pandas_output_v1(args):
     if not pandas_installed:
         raise PandasNotSupported()
+    import pandas as pd
 
     return pd.read_csv(
         BytesIO(run_and_get_output_v1(*args)),
@@ -505,6 +923,7 @@ def get_pandas_output_v1(args):
 def get_pandas_output_v1(args):
     if not pandas_installed:
         raise PandasNotSupported()
+    import pandas as pd
 
     return pd.read_csv(
         BytesIO(run_and_get_output_v1(*args)),
@@ -516,6 +935,7 @@ def get_pandas_output_v1(args):
 def get_pandas_output_v2(args):
     if not pandas_installed:
         raise PandasNotSupported()
+    import pandas as pd
 
     return pd.read_csv(
         BytesIO(run_and_get_output_v2(*args)),
@@ -564,8 +984,14 @@ def image_to_data(image,
         raise TSVNotSupported()
 
     config = '{} {}'.format('-c tessedit_create_tsv=1', config.strip()).strip()
-    _, bmp = cv2.imencode('.bmp', image)
-    args = [bmp, 'tsv', lang, config, nice, timeout]
+    if pool is not None and output_type in {Output.DICT, Output.STRING}:
+        tsv = pool.image_to_data(image, lang, config, timeout)
+        return {
+            Output.DICT: lambda: file_to_dict(tsv, '\t', -1),
+            Output.STRING: lambda: tsv,
+        }[output_type]()
+
+    args = [encode_image(image), 'tsv', lang, config, nice, timeout]
 
     return {
         Output.BYTES: lambda: run_and_get_output_v2(*(args + [True])),
@@ -575,6 +1001,126 @@ def image_to_data(image,
     }[output_type]()
 
 
+def image_to_string_and_confidence(image,
+                                   lang=None,
+                                   config='',
+                                   nice=0,
+                                   timeout=0):
+    """
+    Returns (text, confidence) from the TSV output, confidence is the lowest
+    word confidence (0-100) and 0 when nothing was read
+    """
+    key = None
+    if cache is not None:
+        # cached apart from the plain text of image_to_string
+        key = cache.make_key(image, lang, config + ' #confidence')
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    data = image_to_data(image, lang, config, nice, Output.DICT, timeout)
+    words = [(left, str(text).strip(), float(conf)) for text, left, conf in zip(
+        data['text'], data['left'], data['conf']) if str(text).strip()]
+    result = join_words(words)
+
+    if key is not None:
+        cache.put(key, result)
+    return result
+
+
+def images_to_strings(images,
+                      lang=None,
+                      config='',
+                      nice=0,
+                      timeout=0,
+                      separator=40):
+    """
+    Tiles the images into one sheet separated by blank bands, runs a single
+    OCR pass in block layout mode and returns the text of every image in order
+    """
+    return [text for text, _ in get_batch(images, lang, config, nice, timeout, separator, False)]
+
+
+def images_to_strings_and_confidences(images,
+                                      lang=None,
+                                      config='',
+                                      nice=0,
+                                      timeout=0,
+                                      separator=40):
+    """
+    Same single pass as images_to_strings, returns (text, confidence) for
+    every image like image_to_string_and_confidence
+    """
+    return get_batch(images, lang, config, nice, timeout, separator, True)
+
+
+def get_batch(images, lang, config, nice, timeout, separator, with_confidence):
+    if cache is None:
+        return run_batch(images, lang, config, nice, timeout, separator)
+
+    # plain texts keep their old keys so existing cache files stay valid
+    key_config = config + ' #confidence' if with_confidence else config
+    keys = [cache.make_key(image, lang, key_config) for image in images]
+    results = [cache.get(key) for key in keys]
+    if not with_confidence:
+        # a cached text has no confidence
+        results = [None if text is None else (text, None) for text in results]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        batch = run_batch([images[i] for i in missing], lang, config, nice,
+                          timeout, separator)
+        for i, result in zip(missing, batch):
+            cache.put(keys[i], result if with_confidence else result[0])
+            results[i] = result
+    return results
+
+
+def join_words(words):
+    """
+    Joins (left, text, confidence) words from left to right, returns the
+    text and the lowest confidence
+    """
+    if not words:
+        return '', 0.0
+    words = sorted(words)
+    return ' '.join(text for _, text, _ in words), min(conf for _, _, conf in words)
+
+
+def run_batch(images, lang, config, nice, timeout, separator):
+    if not images:
+        return []
+
+    channels = images[0].shape[2:]
+    width = max(image.shape[1] for image in images) + 2 * separator
+    tops = []
+    height = separator
+    for image in images:
+        tops.append(height)
+        height += image.shape[0] + separator
+
+    sheet = np.full((height, width) + channels, 255, dtype=images[0].dtype)
+    for image, top in zip(images, tops):
+        sheet[top: top + image.shape[0],
+              separator: separator + image.shape[1]] = image
+
+    config = re.sub(r'-?-psm\s+\d+', '', config)
+    config = '{} {}'.format('--psm 6', config.strip()).strip()
+    data = image_to_data(sheet, lang, config, nice, Output.DICT, timeout)
+
+    words = [[] for _ in images]
+    for text, left, top, box_height, conf in zip(
+            data['text'], data['left'], data['top'], data['height'], data['conf']):
+        text = str(text).strip()
+        if not text:
+            continue
+        # every word belongs to the tile its vertical center falls into
+        center = top + box_height / 2
+        index = max(0, bisect_right(tops, center) - 1)
+        words[index].append((left, text, float(conf)))
+
+    return [join_words(tile) for tile in words]
+
+
 def image_to_osd_v1(image,
                  lang='osd',
                  config='',
@@ -597,6 +1143,28 @@ def image_to_osd_v1(image,
     }[output_type]()
 
 
+def image_to_osd(image,
+                 lang='osd',
+                 config='',
+                 nice=0,
+                 output_type=Output.STRING,
+                 timeout=0):
+    """
+    Returns string containing the orientation and script detection (OSD)
+    """
+    config = '{}-psm 0 {}'.format(
+        '' if get_tesseract_version() < '3.05' else '-',
+        config.strip()
+    ).strip()
+    args = [encode_image(image), 'osd', lang, config, nice, timeout]
+
+    return {
+        Output.BYTES: lambda: run_and_get_output_v2(*(args + [True])),
+        Output.DICT: lambda: osd_to_dict(run_and_get_output_v2(*args)),
+        Output.STRING: lambda: run_and_get_output_v2(*args),
+    }[output_type]()
+
+
 def main():
     if len(sys.argv) == 2:
         filename, lang = sys.argv[1], None
@@ -1,48 +1,132 @@
 import json
 import cv2
-import psutil
-import numpy as np
 import os, time
 import pytesseract_v2 as pytesseract
 import sys, traceback
-import importlib
+import concurrent.futures
 from os import listdir
 from os.path import isfile, join, exists
 from shutil import copyfile
 
-from screen_recorder_sdk import screen_recorder
-
 import start
+import storage
+import archive
+import matchdb
 
 # print(start.recognize_scoreboard(cv2.imread('./scoreboards/scoreboard_2020-08-12-01-48-38.png')))
 
 path = './scoreboards'
-scoreboards = [f for f in listdir(path) if isfile(join(path, f)) and f.startswith('scoreboard') and not f.startswith('scoreboard_result')]
-results = [f for f in listdir(path) if isfile(join(path, f)) and f.startswith('scoreboard_result')]
-
-results_array = []
-results_short_array = []
-
-for scoreboard_file in scoreboards:
-  date_text = scoreboard_file.replace('scoreboard_', '').replace('.png', '')
-  result_file = next((r for r in results if r.find(date_text) > -1), None)
-  if result_file is not None:
-    print('File:', scoreboard_file)
-    img = cv2.imread(join(path, scoreboard_file))
-    img_res = cv2.imread(join(path, result_file))
-    players = start.recognize_scoreboard(img)
-    result, value = start.match_result(img_res)
-    print('Result:', result)
+workers = os.cpu_count() or 1
+# pairs submitted to the pool but not finished yet, keeps memory bounded on big archives
+max_in_flight = workers * 2
+screenshots = None
+
+
+def get_date_text(filename):
+  return filename.replace('scoreboard_result_', '').replace('scoreboard_', '').replace('.png', '')
+
+
+def find_pairs(path, archived=()):
+  files = sorted(set(f for f in listdir(path) if isfile(join(path, f)) and f.startswith('scoreboard') and f.endswith('.png')) | set(archived))
+  results = { get_date_text(f): f for f in files if f.startswith('scoreboard_result') }
+  return [(f, results[get_date_text(f)]) for f in files if not f.startswith('scoreboard_result') and get_date_text(f) in results]
+
+
+def open_archive():
+  return archive.open_dir(path)
+
+
+def init_worker():
+  global screenshots
+  # the main process writes whatever the workers add to the cache
+  pytesseract.enable_cache(path=start.ocr_cache_file, read_only=True)
+  screenshots = open_archive()
+
+
+def process_pair(scoreboard_file, result_file):
+  img = archive.read_screenshot(path, scoreboard_file, screenshots)
+  img_res = archive.read_screenshot(path, result_file, screenshots)
+  players = start.recognize_scoreboard(img)
+  start.get_layout(img_res)
+  result, value = start.match_result(img_res)
+  cache = pytesseract.cache
+  new_entries = dict(cache.new_entries)
+  cache.new_entries.clear()
+  return players, result, new_entries, os.getpid(), cache.stats()
+
+
+def main():
+  pairs = find_pairs(path, open_archive().names())
+  print(f"Found {len(pairs)} scoreboards with results, using {workers} workers")
+
+  processed = [None] * len(pairs)
+  new_cache_entries = {}
+  cache_stats = {}
+  started = time.time()
+  done = 0
+  with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker) as executor:
+    in_flight = {}
+    next_pair = 0
+    while next_pair < len(pairs) or in_flight:
+      while next_pair < len(pairs) and len(in_flight) < max_in_flight:
+        future = executor.submit(process_pair, *pairs[next_pair])
+        in_flight[future] = next_pair
+        next_pair += 1
+      finished, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in finished:
+        index = in_flight.pop(future)
+        done += 1
+        try:
+          players, result, new_entries, pid, stats = future.result()
+        except Exception:
+          traceback.print_exc(file=sys.stdout)
+          print(f"Error recognizing {pairs[index][0]}")
+          continue
+        processed[index] = (players, result)
+        new_cache_entries.update(new_entries)
+        # every worker reports its own running totals
+        cache_stats[pid] = stats
+        elapsed = time.time() - started
+        print(f"[{done}/{len(pairs)}] {pairs[index][0]}: {result}, {done / elapsed:.1f} scoreboards/s")
+
+  results_array = []
+  results_short_array = []
+  for (scoreboard_file, result_file), item in zip(pairs, processed):
+    if item is None:
+      continue
+    players, result = item
     results_array.append({ 'result': result, 'players': players, 'result_file': result_file, 'scoreboard_file': scoreboard_file })
     results_short_array.append({ 'result': result, 'result_file': result_file, 'players': list(map(start.get_player_level, players)) })
 
-if exists('results.json'):
-  copyfile('results.json', 'results_backup.json')
-if exists('results_short.json'):
-  copyfile('results_short.json', 'results_short_backup.json')
+  if exists('results.json'):
+    copyfile('results.json', 'results_backup.json')
+  if exists('results_short.json'):
+    copyfile('results_short.json', 'results_short_backup.json')
+
+  ocr_cache = pytesseract.enable_cache(path=start.ocr_cache_file)
+  ocr_cache.update(new_cache_entries)
+  pytesseract.disable_cache()
+  totals = { key: sum(stats[key] for stats in cache_stats.values()) for key in ('hits', 'disk_hits', 'misses') }
+  print('OCR cache:', totals)
+  print(f"Processed {done} scoreboards in {time.time() - started:.1f}s")
+
+  with open('results.json', 'w') as file:
+    json.dump(results_array, file, indent=1)
+
+  with open("results_short.json", "w") as file:
+    json.dump(results_short_array, file, indent=1)
+
+  if start.storage_mode == 'jsonl':
+    storage.json_to_jsonl('results.json', start.results_log_file)
+    storage.json_to_jsonl('results_short.json', start.results_short_log_file)
+
+  if start.use_match_db:
+    conn = matchdb.connect()
+    with conn:
+      conn.execute('DELETE FROM matches')
+    matchdb.import_matches(conn, 'results.json')
+    conn.close()
 
-with open('results.json', 'w') as file:
-  json.dump(results_array, file, indent=1)
 
-with open("results_short.json", "w") as file:
-  json.dump(results_short_array, file, indent=1)
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,48 @@
+"""
+Capture interval for the main loop, adapted to the tracker state and to how
+much the frames are changing.
+"""
+
+import time
+
+
+class PollScheduler:
+    """
+    Polls at scoreboard_interval while waiting for a scoreboard and at the
+    faster result_interval once a match is being tracked, so a short result
+    screen is not missed. While frames stop changing the interval grows by
+    backoff up to the state's cap, and a changed frame brings it back down.
+    Minimized game polls at max_interval
+    """
+
+    def __init__(self, min_interval=0.25, max_interval=5, scoreboard_interval=1,
+                 result_interval=0.5, result_max_interval=1.5, backoff=1.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.scoreboard_interval = scoreboard_interval
+        self.result_interval = result_interval
+        self.result_max_interval = result_max_interval
+        self.backoff = backoff
+        self.interval = scoreboard_interval
+        self.last_tick = None
+
+    def update(self, state, changed=True, minimized=False):
+        if minimized:
+            self.interval = self.max_interval
+        elif state == 'result':
+            self.interval = self.result_interval if changed else min(
+                self.interval * self.backoff, self.result_max_interval)
+        else:
+            self.interval = self.scoreboard_interval if changed else self.interval * self.backoff
+        self.interval = min(max(self.interval, self.min_interval), self.max_interval)
+        return self.interval
+
+    def wait(self):
+        """
+        Sleeps until the current interval has passed since the previous wait,
+        so time spent processing a frame counts towards it
+        """
+        now = time.monotonic()
+        if self.last_tick is not None:
+            time.sleep(max(0, self.interval - (now - self.last_tick)))
+        self.last_tick = time.monotonic()
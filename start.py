@@ -1,22 +1,30 @@
+import time
+# imports and module setup count towards the time to first frame
+import_started = time.perf_counter()
 import json
 import cv2
-import psutil
 import numpy as np
 import os
-import time
 import pytesseract_v2 as pytesseract
+import digits
+import storage
+import matchdb
+import frames
+import scheduler
+import layouts
+import matcher
+import metrics
 import sys
 import traceback
-import importlib
-import win32process
-import win32gui
-import threading
-import ctypes
+import concurrent.futures
+import capture
+import pipeline
+import consensus
+import archive
+import template_bank
 from sty import bg, fg
 from pathlib import Path
 
-from screen_recorder_sdk import screen_recorder
-
 if sys.platform == "win32":
     os.system('color')
 
@@ -28,13 +36,17 @@ victory = 'W'
 defeat = 'L'
 draw = 'D'
 
+# templates and masks, decoded once into templates/templates.bank
+template_images = template_bank.load(
+    ('my_team', 'scoreboard', 'victory', 'victory_mask', 'defeat', 'defeat_mask', 'draw', 'draw_mask'))
+
 # scoreboard values
 my_team_template = {
     'x': 890,
     'y': 330,
     'w': 173,
     'h': 34,
-    'template': cv2.imread('./templates/my_team.png'),
+    'template': template_images['my_team'],
     'mask': None,
 }
 scoreboard_template = {
@@ -42,7 +54,7 @@ scoreboard_template = {
     'y': 393,
     'w': 139,
     'h': 195,
-    'template': cv2.imread('./templates/scoreboard.png'),
+    'template': template_images['scoreboard'],
     'mask': None,
 }
 victory_template = {
@@ -50,25 +62,37 @@ victory_template = {
     'y': 365,
     'w': 581,
     'h': 168,
-    'template': cv2.imread('./templates/victory.png'),
-    'mask': cv2.imread('./templates/victory_mask.png'),
+    'template': template_images['victory'],
+    'mask': template_images['victory_mask'],
 }
 defeat_template = {
     'x': 1050,
     'y': 367,
     'w': 463,
     'h': 166,
-    'template': cv2.imread('./templates/defeat.png'),
-    'mask': cv2.imread('./templates/defeat_mask.png'),
+    'template': template_images['defeat'],
+    'mask': template_images['defeat_mask'],
 }
 draw_template = {
     'x': 1074,
     'y': 366,
     'w': 419,
     'h': 167,
-    'template': cv2.imread('./templates/draw.png'),
-    'mask': cv2.imread('./templates/draw_mask.png'),
+    'template': template_images['draw'],
+    'mask': template_images['draw_mask'],
 }
+# how far to the right of a level box top left corner to look for its segments
+width_to_check = 65
+# result checks first compare this many probe pixels, frames scoring below probe_threshold
+# skip the full-resolution match (which needs 0.99)
+use_match_cascade = True
+probe_count = 256
+probe_threshold = 0.98
+# score a result template needs to count as found
+result_threshold = 0.99
+# parts of the frame each state has to look at
+scoreboard_regions = [scoreboard_template]
+result_regions = [victory_template, defeat_template, draw_template]
 # coordinates for level boxes
 level_boxes_top_left = [
     # my team
@@ -131,44 +155,31 @@ border_level_add = (
 )
 
 
-def get_pid_state(pid):
-    state = None
-    windows = []
-
-    def callback(hwnd, arg):
-        windows.append(hwnd)
-    win32gui.EnumWindows(callback, None)
-    for hwnd in windows:
-        if pid in win32process.GetWindowThreadProcessId(hwnd):
-            placement = win32gui.GetWindowPlacement(hwnd)
-            if placement[4][2] == 2560 and placement[4][3] == 1440:
-                state = placement[1]
-    return state
-
+def get_pixel_diffs(pixels1, pixels2):
+    # max per-channel difference, broadcast over any leading dimensions
+    return np.abs(pixels1.astype(np.int16) - pixels2.astype(np.int16)).max(axis=-1)
 
-def get_pixel_diff(pixel1, pixel2):
-    return max(abs(int(pixel1[0]) - int(pixel2[0])), abs(int(pixel1[1]) - int(pixel2[1])), abs(int(pixel1[2]) - int(pixel2[2])))
 
-
-def is_pixels_almost_equal(pixel1, pixel2):
-    return get_pixel_diff(pixel1, pixel2) < 5
-
-
-def is_golden_color(bgr_pixel):
-    max_color = max(bgr_pixel)
-    if max_color != bgr_pixel[2]:
-        return False
-    min_color = min(bgr_pixel)
-    hue = 60 * (int(bgr_pixel[1]) - int(bgr_pixel[0])
-                ) / (int(max_color) - int(min_color))
-    if hue < 0:
-        hue = hue + 360
-    return hue > 35 and hue < 55
+def get_golden_mask(bgr_pixels):
+    """
+    Gold border hue test for an array of pixels. Returns (golden, gray):
+    gray pixels have no hue and made the per-pixel check divide by zero
+    """
+    bgr_pixels = bgr_pixels.astype(np.int16)
+    max_color = bgr_pixels.max(axis=-1)
+    spread = max_color - bgr_pixels.min(axis=-1)
+    red_is_max = max_color == bgr_pixels[..., 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hue = 60 * (bgr_pixels[..., 1] - bgr_pixels[..., 0]) / spread
+    hue = np.where(hue < 0, hue + 360, hue)
+    return red_is_max & (hue > 35) & (hue < 55), red_is_max & (spread == 0)
 
 
-def is_matched(image, template, threshold=0.99):
-    crop = image[template['y']: template['y'] + template['h'],
-                 template['x']: template['x'] + template['w']]
+def is_matched(image, template, threshold=0.99, origin=(0, 0)):
+    # origin is where image starts in the full frame, when it is only a region of it
+    x = template['x'] - origin[0]
+    y = template['y'] - origin[1]
+    crop = image[y: y + template['h'], x: x + template['w']]
     if template['mask'] is not None:
         res = cv2.matchTemplate(
             crop, template['template'], cv2.TM_CCORR_NORMED, mask=template['mask'])
@@ -179,125 +190,322 @@ def is_matched(image, template, threshold=0.99):
     return maxVal >= threshold, maxVal
 
 
-def is_star_bg(pixel, color_pixel):
-    # diamond color of player
-    if is_pixels_almost_equal(color_pixel, border_colors[3]):
-        # dark blue background color of stars block
-        return is_pixels_almost_equal(pixel, [181, 106, 86])
-    # white background color of stars block
-    return is_pixels_almost_equal(pixel, [252, 252, 252])
+def find_color_indexes(pixels):
+    matches = get_pixel_diffs(pixels[:, None], np.array(border_colors)) < 5
+    return [int(row.argmax()) if row.any() else None for row in matches]
 
 
-def find_color_index(pixel):
-    for i in range(len(border_colors)):
-        if is_pixels_almost_equal(pixel, border_colors[i]):
-            return i
+def first_true(mask, offset=0):
+    index = int(mask.argmax()) if mask.size else 0
+    return index + offset if mask.size and mask[index] else None
 
 
-def match_result(img):
+def add_probes(template, count=probe_count):
+    """
+    Picks evenly spread pixels inside the mask of a template and stores
+    their masked values, for a cheap estimate of the TM_CCORR_NORMED score
+    """
+    mask = template['mask'] if template['mask'] is not None else np.full_like(template['template'], 255)
+    ys, xs, channels = np.nonzero(mask)
+    picked = np.linspace(0, len(ys) - 1, min(count, len(ys))).astype(int)
+    template['probes'] = (ys[picked], xs[picked], channels[picked])
+    template['probe_weights'] = mask[template['probes']].astype(np.float32)
+    template['probe_values'] = template['template'][template['probes']] * template['probe_weights']
+    template['probe_norm'] = float(np.sqrt((template['probe_values'] ** 2).sum()))
+
+
+def get_probe_score(image, template, origin=(0, 0)):
+    ys, xs, channels = template['probes']
+    values = image[ys + template['y'] - origin[1], xs + template['x'] -
+                   origin[0], channels] * template['probe_weights']
+    denominator = template['probe_norm'] * np.sqrt((values ** 2).sum())
+    return float(values @ template['probe_values'] / denominator) if denominator else 0.0
+
+
+def match_result(img, origin=(0, 0)):
+    """
+    Cascade: a few hundred probe pixels reject frames without a result
+    banner, only the rest get the full masked template score
+    """
     maxValue = 0
-    match, value = is_matched(img, victory_template)
-    maxValue = max(value, maxValue)
-    if match:
-        return victory, value
-    match, value = is_matched(img, defeat_template)
-    maxValue = max(value, maxValue)
-    if match:
-        return defeat, value
-    match, value = is_matched(img, draw_template)
-    maxValue = max(value, maxValue)
-    if match:
-        return draw, value
+    candidates = []
+    for result, template in ((victory, victory_template), (defeat, defeat_template), (draw, draw_template)):
+        # the stats show the share each stage rejects, e.g. cascade_probe_rejected_W / cascade_frames_W
+        metrics.count(f'cascade_frames_{result}')
+        if use_match_cascade:
+            value = get_probe_score(img, template, origin)
+            if value < probe_threshold:
+                metrics.count(f'cascade_probe_rejected_{result}')
+                maxValue = max(value, maxValue)
+                continue
+        candidates.append(result)
+    if not candidates:
+        return None, maxValue
+    # the templates left are scored in one call, the first one above the threshold wins
+    scores = result_matcher.scores(img, origin, candidates)
+    for result in candidates:
+        value = scores[result]
+        maxValue = max(value, maxValue)
+        if value >= result_threshold:
+            metrics.count(f'cascade_matched_{result}')
+            return result, value
+        metrics.count(f'cascade_confirm_rejected_{result}')
     return None, maxValue
 
 
-def recognize_scoreboard(img):
-    players = []
-    for player_number in range(12):
-        # print(f"-- Player {player_number + 1}")
-        left_dot = level_boxes_top_left[player_number]
-        width_to_check = 65
-        first_pixel = img[left_dot[1], left_dot[0]]
-        prev_stable_pixel = img[left_dot[1], left_dot[0]]
+def apply_layout(width, height):
+    """
+    Switches the templates to the ones scaled for a frame size
+    """
+    global layout, my_team_template, scoreboard_template, victory_template, defeat_template, draw_template
+    global scoreboard_regions, result_regions, result_matcher
+    layout = layouts.load_layout(base_templates, width, height)
+    # the row scanner reads exact pixels, so it samples the frame itself at the scaled positions
+    layout['level_boxes'] = [layouts.scale_point(point, layout['transform']) for point in level_boxes_top_left]
+    my_team_template = layout['templates']['my_team']
+    scoreboard_template = layout['templates']['scoreboard']
+    victory_template = layout['templates']['victory']
+    defeat_template = layout['templates']['defeat']
+    draw_template = layout['templates']['draw']
+    scoreboard_regions = [scoreboard_template]
+    result_regions = [victory_template, defeat_template, draw_template]
+    for template in result_regions:
+        add_probes(template)
+    # the scoreboard template slides over its region and stays on cv2.matchTemplate
+    result_matcher = matcher.TemplateMatcher(
+        {victory: victory_template, defeat: defeat_template, draw: draw_template})
+    return layout
+
+
+def get_layout(img):
+    if layout is None or layout['size'] != (img.shape[1], img.shape[0]):
+        apply_layout(img.shape[1], img.shape[0])
+    return layout
+
+
+base_templates = {'my_team': my_team_template, 'scoreboard': scoreboard_template,
+                  'victory': victory_template, 'defeat': defeat_template, 'draw': draw_template}
+layout = None
+apply_layout(*layouts.base_size)
+
+
+def analyse_rows(img, boxes=None, scale=1):
+    """
+    Finds stable color segments, stars and the gold border of all 12 level
+    rows with array operations. Returns (stable_offsets, stars, has_gold_border)
+    for every row, None for a row that can't be read, offsets in pixels of img. boxes are the level box corners
+    in img, scale its size relative to 2560x1440
+    """
+    boxes = level_boxes_top_left if boxes is None else boxes
+    width = round(width_to_check * scale)
+    lefts = np.array(boxes)
+    strips = img[lefts[:, 1, None], lefts[:, 0, None] +
+                 np.arange(width + 2)].astype(np.int16)
+    # diffs[row, a, b] is the difference between pixels a and b of the row
+    diffs = get_pixel_diffs(strips[:, :, None], strips[:, None, :])
+    offsets = np.arange(width)
+    # pixel followed by two pixels of the same color
+    stable = (diffs[:, offsets, offsets + 1] < 5) & (diffs[:, offsets + 1, offsets + 2] < 5)
+    golden, gray = get_golden_mask(strips[:, :width])
+    background = diffs[:, 0, :width] < 5
+    white_star_bg = get_pixel_diffs(strips[:, :width], np.array([252, 252, 252])) < 5
+    # diamond players have a dark blue stars block
+    blue_star_bg = get_pixel_diffs(strips[:, :width], np.array([181, 106, 86])) < 5
+    is_diamond = get_pixel_diffs(strips, np.array(border_colors[3])) < 5
+
+    rows = []
+    for row, (x, y) in enumerate(boxes):
         stable_offsets = []
         stars = -1
         star_bg_start = -1
-        has_gold_border = False
-        # print(f"-- First pixel color: {first_pixel}, coords: [{left_dot[0]}, {left_dot[1]}]")
-        for width_offset in range(width_to_check):
-            current_pixel = img[left_dot[1], left_dot[0] + width_offset]
-            next_pixel = img[left_dot[1], left_dot[0] + width_offset + 1]
-            next_next_pixel = img[left_dot[1], left_dot[0] + width_offset + 2]
-            # print(f"Curr {current_pixel}, first {first_pixel}")
-            if stable_offsets:
-                if is_pixels_almost_equal(current_pixel, first_pixel):
-                    # Got to background again, end the loop
-                    # print(f"Offset {width_offset}")
-                    # print(f"Background condition abort")
-                    stars = 0
-                    stable_offsets.append(width_offset)
-                    break
-            else:
-                # Still on first background block, but color is different - check if we have a golden border here
-                if is_golden_color(current_pixel):
-                    has_gold_border = True
-
-            diff = get_pixel_diff(current_pixel, prev_stable_pixel)
-            diff_next = get_pixel_diff(current_pixel, next_pixel)
-            diff_next_next = get_pixel_diff(next_pixel, next_next_pixel)
-            if diff > 35 and diff_next < 5 and diff_next_next < 5:
-                # print(f"Offset {width_offset}, {current_pixel}")
-                # print(f"New stable pixel")
-                if stable_offsets and is_star_bg(current_pixel, img[left_dot[1], left_dot[0] + stable_offsets[0]]):
-                    # print(f"Found start of stars BG")
-                    star_bg_start = width_offset
-                stable_offsets.append(width_offset)
-                prev_stable_pixel = img[left_dot[1],
-                                        left_dot[0] + width_offset]
-        # print(f"Stable offsets: {stable_offsets}")
+        offset = first_true(stable[row] & (diffs[row, 0, :width] > 35))
+        # still on first background block, check if we have a golden border here
+        first_block_end = width if offset is None else offset + 1
+        if gray[row, :first_block_end].any():
+            # gray has no hue, the gold border test can't tell
+            print(f'Warning: gray level box border for player {row + 1}')
+            rows.append(None)
+            continue
+        has_gold_border = bool(golden[row, :first_block_end].any())
+        if offset is not None:
+            stable_offsets.append(offset)
+            # a pixel into the segment, the edge of a scaled frame can still be blurred
+            star_bg = blue_star_bg[row] if is_diamond[row, offset + round(scale) - 1] else white_star_bg[row]
+        while offset is not None:
+            start = offset + 1
+            back_offset = first_true(background[row, start:], start)
+            offset = first_true(stable[row, start:] & (diffs[row, offset, start:width] > 35), start)
+            if back_offset is not None and (offset is None or back_offset <= offset):
+                # got to background again
+                stars = 0
+                stable_offsets.append(back_offset)
+                break
+            if offset is not None:
+                if star_bg[offset]:
+                    star_bg_start = offset
+                stable_offsets.append(offset)
         if star_bg_start > 0:
-            start_pixel = img[left_dot[1], left_dot[0] + star_bg_start]
-            star_bg_offset = 0
-            while 10 > get_pixel_diff(start_pixel, img[left_dot[1], left_dot[0] + star_bg_start + star_bg_offset]):
-                star_bg_offset += 1
-            # print(f"Start p: {start_pixel}, End p: {img[left_dot[1], left_dot[0] + star_bg_start + star_bg_offset]}")
-            star_bg_end = star_bg_start + star_bg_offset
-            stars = round((star_bg_offset - 2) / 10)
+            star_bg = img[y, x + star_bg_start:]
+            star_bg_end = first_true(get_pixel_diffs(star_bg, star_bg[0]) >= 10)
+            if star_bg_end is None:
+                print(f'Warning: stars block of player {row + 1} runs past the right edge of the image')
+                rows.append(None)
+                continue
+            # stars are 10 pixels wide at 2560x1440
+            stars = round((star_bg_end / scale - 2) / 10)
+        rows.append((stable_offsets, stars, has_gold_border))
+    return rows
+
+
+def scan_rows(img, frame_layout=None):
+    """
+    Returns one row (level crop, stars and color) per level box, None for
+    the rows where no level box was found. img is a frame of frame_layout,
+    2560x1440 by default; the crops are scaled to their 2560x1440 size
+    """
+    scale = 1 if frame_layout is None else frame_layout['transform'][0]
+    boxes = level_boxes_top_left if frame_layout is None else frame_layout['level_boxes']
+    # the crop starts one pixel above the level box corner and is 17 pixels high at 2560x1440
+    top, height, margin = round(scale), round(17 * scale), round(3 * scale)
+    rows = []
+    for player_number, analysis in enumerate(analyse_rows(img, boxes, scale)):
+        if analysis is None:
+            rows.append(None)
+            continue
+        stable_offsets, stars, has_gold_border = analysis
+        left_dot = boxes[player_number]
         if len(stable_offsets) == 1:
             print(
                 'Warning: not found the second stable offset; using {width_to_check}')
-            stable_offsets.append(width_to_check)
-        player_level_crop = img[left_dot[1] - 1: left_dot[1] + 16, left_dot[0] +
-                                stable_offsets[0] + 3: left_dot[0] + stable_offsets[1] - 3]
-        border_color = player_level_crop[0, 0]
-        color_index = find_color_index(border_color)
+            stable_offsets.append(round(width_to_check * scale))
+        try:
+            player_level_crop = img[left_dot[1] - top: left_dot[1] - top + height, left_dot[0] +
+                                    stable_offsets[0] + margin: left_dot[0] + stable_offsets[1] - margin]
+            border_color = player_level_crop[0, 0]
+        except IndexError:
+            print(f'Warning: no level box found for player {player_number + 1}')
+            rows.append(None)
+            continue
+        if scale != 1:
+            # the glyph bank and the OCR preprocessing are tuned for 2560x1440 crops
+            player_level_crop = layouts.scale_image(
+                player_level_crop, (max(1, round(player_level_crop.shape[1] / scale)), 17))
+        rows.append({'crop': player_level_crop, 'border_color': border_color,
+                     'stars': stars, 'has_gold_border': has_gold_border})
+
+    found = [row for row in rows if row is not None]
+    if not found:
+        return rows
+    border_colors_found = np.array([row.pop('border_color') for row in found])
+    for row, border_color, color_index in zip(found, border_colors_found, find_color_indexes(border_colors_found)):
         color = '?'
         level_add = 0
-        print_color = bg(0)
         if color_index is not None:
-            if color_index == 1 and has_gold_border:
+            if color_index == 1 and row['has_gold_border']:
                 color_index = 4
             color = border_color_names[color_index]
-            print_color = print_colors[color_index]
             level_add = border_level_add[color_index]
         else:
             print(f"Unknown color {border_color}")
+        row['color'] = color
+        row['level_base'] = level_add
+    return rows
 
-        player_level_crop = cv2.resize(
-            player_level_crop, (player_level_crop.shape[1] * 4, player_level_crop.shape[0] * 4), interpolation=cv2.INTER_LANCZOS4)
-        if color == 'bronze':
-            player_level_crop = cv2.bitwise_not(player_level_crop)
-        player_level_crop = cv2.cvtColor(player_level_crop, cv2.COLOR_BGR2GRAY)
-        player_level_crop = cv2.adaptiveThreshold(
-            player_level_crop, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 71, 10)
-        player_level = pytesseract.image_to_string(
-            player_level_crop, config=config_number)
-        if player_level == '':
-            player_level = '0'
-        # cv2.imwrite(f'./numbers/{player_number}_{player_level}.png', player_level_crop)
-        players.append(
-            {'level': player_level, 'level_base': level_add, 'color': color, 'stars': stars})
-        # print(f"Level: {player_level}, Stars: {stars}, Color: {border_color}")
+
+def preprocess_level_crop(player_level_crop, color, scale=4, block_size=71, invert=False):
+    # invert flips the usual choice of inverting only bronze levels
+    player_level_crop = cv2.resize(
+        player_level_crop, (player_level_crop.shape[1] * scale, player_level_crop.shape[0] * scale), interpolation=cv2.INTER_LANCZOS4)
+    if (color == 'bronze') != invert:
+        player_level_crop = cv2.bitwise_not(player_level_crop)
+    player_level_crop = cv2.cvtColor(player_level_crop, cv2.COLOR_BGR2GRAY)
+    return cv2.adaptiveThreshold(
+        player_level_crop, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, block_size, 10)
+
+
+def get_digit_bank():
+    global digit_bank
+    if digit_bank is None:
+        digit_bank = digits.load_bank() or False
+    return digit_bank
+
+
+def ocr_levels(level_crops, batch):
+    """
+    Returns (text, confidence) for every crop
+    """
+    metrics.count('ocr_calls', 1 if batch else len(level_crops))
+    with metrics.stage('ocr'):
+        if batch:
+            return pytesseract.images_to_strings_and_confidences(level_crops, config=config_number)
+        return [pytesseract.image_to_string_and_confidence(crop, config=config_number) for crop in level_crops]
+
+
+def read_levels_with_confidence(level_crops, batch=None):
+    if batch is None:
+        batch = batch_ocr
+    readings = [None] * len(level_crops)
+    bank = get_digit_bank() if use_digit_classifier else False
+    if bank:
+        for i, crop in enumerate(level_crops):
+            text, margin = bank.read(crop)
+            if margin >= digits.min_margin:
+                readings[i] = (text, 100.0)
+    # only the crops the classifier is unsure about go to tesseract
+    uncertain = [i for i, reading in enumerate(readings) if reading is None]
+    if uncertain:
+        for i, reading in zip(uncertain, ocr_levels([level_crops[i] for i in uncertain], batch)):
+            readings[i] = reading
+    return readings
+
+
+def is_level_plausible(text):
+    return text.isdigit() and 1 <= int(text) <= 100
+
+
+def needs_reread(text, confidence):
+    return confidence < min_level_confidence or not is_level_plausible(text)
+
+
+def reread_level(crop, color, text, confidence):
+    """
+    Reads a doubtful level again with each of level_reread_options until one
+    reading is confident, returns the best (text, confidence) seen
+    """
+    best = (is_level_plausible(text), confidence, text)
+    for options in level_reread_options:
+        metrics.count('level_rereads')
+        retry_text, retry_confidence = ocr_levels([preprocess_level_crop(crop, color, **options)], batch=False)[0]
+        best = max(best, (is_level_plausible(retry_text), retry_confidence, retry_text))
+        if not needs_reread(retry_text, retry_confidence):
+            break
+    return best[2], best[1]
+
+
+def recognize_level(crop, color):
+    text, confidence = read_levels_with_confidence([preprocess_level_crop(crop, color)], batch=False)[0]
+    if needs_reread(text, confidence):
+        text, confidence = reread_level(crop, color, text, confidence)
+    return text
+
+
+def init_recognition_process():
+    # a worker of its own, the parent's pool pipes are not shared with forked children
+    if use_tesseract_pool and pytesseract.tesserocr_installed:
+        pytesseract.start_pool()
+
+
+def get_recognition_executor():
+    global recognition_executor
+    if recognition_executor is None:
+        if recognition_use_processes:
+            recognition_executor = concurrent.futures.ProcessPoolExecutor(recognition_workers, initializer=init_recognition_process)
+        else:
+            recognition_executor = concurrent.futures.ThreadPoolExecutor(recognition_workers)
+    return recognition_executor
+
+
+def print_scoreboard(players):
     print("  My team                 Enemy team")
     for i in range(6):
         # print(f"- Player {i + 1}:\t\t- Player {i + 7}")
@@ -318,46 +526,61 @@ def recognize_scoreboard(img):
         part2 += f"{cr3}{players[i+6]['color']}{fg.rs}    "[:9 +
                                                             len(cr3) + len(fg.rs)]
         print(f"{part1} {part2}")
+
+
+def recognize_rows(img, indexes=None):
+    """
+    Recognizes the players in the rows at indexes, all 12 by default.
+    Returns {index: player}
+    """
+    with metrics.stage('scan_rows'):
+        rows = scan_rows(img, get_layout(img))
+    rows = {index: rows[index] for index in (range(len(rows)) if indexes is None else indexes)}
+    missing = [index + 1 for index, row in rows.items() if row is None]
+    if missing:
+        raise ValueError(f'No level box found for players {missing}')
+    if recognition_workers:
+        # rows are independent, executor.map gives the results back in order
+        player_levels = list(get_recognition_executor().map(
+            recognize_level, [row['crop'] for row in rows.values()], [row['color'] for row in rows.values()]))
+    else:
+        with metrics.stage('preprocess'):
+            level_crops = [preprocess_level_crop(row['crop'], row['color']) for row in rows.values()]
+        # for player_number, crop in enumerate(level_crops):
+        #     cv2.imwrite(f'./numbers/{player_number}.png', crop)
+        readings = read_levels_with_confidence(level_crops)
+        # most rows are read once, only the doubtful ones get the alternative preprocessing
+        for i, (row, (text, confidence)) in enumerate(zip(rows.values(), readings)):
+            if needs_reread(text, confidence):
+                readings[i] = reread_level(row['crop'], row['color'], text, confidence)
+        player_levels = [text for text, _ in readings]
+    players = {}
+    for (index, row), player_level in zip(rows.items(), player_levels):
+        if player_level == '':
+            print(f'Warning: could not read the level of player {index + 1}, using 0')
+            player_level = '0'
+        players[index] = {'level': player_level, 'level_base': row['level_base'],
+                          'color': row['color'], 'stars': row['stars']}
+        # print(f"Level: {player_level}, Stars: {row['stars']}, Color: {row['color']}")
     return players
 
 
-def find_pid_by_name(process_name):
-    '''
-    Get a list of all the PIDs of a all the running process whose name contains
-    the given string process_name
-    '''
-    process_objects = []
-    # Iterate over the all the running process
-    for proc in psutil.process_iter():
-        try:
-            pinfo = proc.as_dict(attrs=['pid', 'name', 'create_time'])
-            # Check if process name contains the given name string.
-            if process_name.lower() in pinfo['name'].lower():
-                process_objects.append(pinfo)
-        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-            pass
-    return process_objects
+def recognize_scoreboard(img):
+    players = list(recognize_rows(img).values())
+    print_scoreboard(players)
+    return players
 
 
 def pil_to_cv2_image(pil_image):
     return cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
 
 
-def get_pid():
-    overwatch_pid = None
-    while overwatch_pid is None:
-        processes = find_pid_by_name('overwatch.exe')
-        if processes:
-            overwatch_pid = processes[0]['pid']
-        else:
-            time.sleep(3)
-    return overwatch_pid
-
-
 def restart_program():
     """Restarts the current program, with file objects and descriptors
         cleanup
     """
+    # execl skips the exit handlers, the OCR cache has to be written out first
+    pytesseract.disable_cache()
     python = sys.executable
     os.execl(python, python, *sys.argv)
 
@@ -366,18 +589,163 @@ def restart_program():
 waiting_for = 'scoreboard'
 current_match = None
 pause_between_screenshots = 1
+# the pause adapts to the state and frame activity within these bounds, see scheduler.py
+min_pause_between_screenshots = 0.25
+max_pause_between_screenshots = 5
+# where the state, results and screenshots are written, `--replay-output` moves them
+state_file = 'state.json'
+results_file = 'results.json'
+results_short_file = 'results_short.json'
+screenshots_dir = './scoreboards'
+errors_dir = './scoreboards_errors'
+# 'jsonl' appends every match to a log and rewrites the json files every compact_every matches,
+# 'json' rewrites results.json and results_short.json on every match
+storage_mode = 'jsonl'
+results_log_file = 'results.jsonl'
+results_short_log_file = 'results_short.jsonl'
+compact_every = 20
+matches_since_compaction = 0
+# skip matching and recognition when the frame looks like the last processed one
+use_frame_gate = True
+frame_gate = frames.FrameGate()
+# `--stats` writes stage timings and counters here
+metrics_file = 'stats.json'
+# also keep matches in matches.db for `python matchdb.py` stats
+use_match_db = False
+match_db = None
+# read all 12 levels in one tesseract pass instead of one call per player
+batch_ocr = True
+# recognize the 12 rows concurrently on this many workers, 0 to use a single batch instead
+recognition_workers = 0
+# use child processes instead of threads for concurrent recognition
+recognition_use_processes = False
+recognition_executor = None
+# read levels with the glyph bank from `python digits.py train`, tesseract only as a fallback
+use_digit_classifier = True
+digit_bank = None
+# OCR results are cached by crop content, on disk so they survive restarts and rescans
+ocr_cache_file = './ocr_cache'
+# keep tesseract workers warm between scoreboards (needs tesserocr)
+use_tesseract_pool = True
+# levels read with a tesseract confidence below this, or outside 1-100, are read again
+# from the crop with each of these preprocessing changes until one is confident
+min_level_confidence = 70
+level_reread_options = ({'scale': 6}, {'block_size': 31}, {'invert': True})
+# capture on its own thread and leave recognition and file writes to background workers,
+# so a short result screen is not missed while a scoreboard is being processed
+use_pipeline = True
+# captured frames waiting to be processed, the oldest is dropped when capture gets ahead
+frame_queue_size = 4
+frames_captured = 0
+# 'png' saves full screenshots, 'pack' only the regions recognition needs, see archive.py
+archive_mode = 'pack'
+# downscaled copy of the whole frame kept in the pack, 0 for none
+archive_preview_scale = 0.25
+# pixels to the right of a level box corner kept in the pack, room for the level and 5 stars
+archive_strip_width = 200
+screenshot_archive = None
+# keep reading the scoreboard while it stays open and vote per row, rows that agreed
+# consensus_agree times are not read again
+use_consensus = True
+consensus_agree = 2
+consensus_max_frames = 8
+scoreboard_consensus = None
+consensus_pending = None
 
 
-def save_state():
-    global waiting_for, current_match
-    with open('state.json', 'w') as f:
-        json.dump({'waiting_for': waiting_for,
-                   'current_match': current_match}, f, indent=1)
+def get_error_file(filename):
+    return os.path.join(errors_dir, os.path.basename(filename))
+
+
+def set_output_dir(path):
+    """
+    Writes the state, results, match database, OCR cache and screenshots
+    under path instead of next to start.py
+    """
+    global state_file, results_file, results_short_file, results_log_file, results_short_log_file
+    global screenshots_dir, errors_dir, ocr_cache_file
+    Path(path).mkdir(parents=True, exist_ok=True)
+    state_file = os.path.join(path, state_file)
+    results_file = os.path.join(path, results_file)
+    results_short_file = os.path.join(path, results_short_file)
+    results_log_file = os.path.join(path, results_log_file)
+    results_short_log_file = os.path.join(path, results_short_log_file)
+    matchdb.db_file = os.path.join(path, matchdb.db_file)
+    screenshots_dir = os.path.join(path, 'scoreboards')
+    errors_dir = os.path.join(path, 'scoreboards_errors')
+    ocr_cache_file = os.path.join(path, os.path.basename(ocr_cache_file))
+
+
+def save_png(filename, img):
+    with metrics.stage('png_write'):
+        cv2.imwrite(filename, img, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+
+
+def get_archive_regions(filename):
+    """
+    Regions of a base size frame that are kept in the pack for a screenshot
+    """
+    if 'scoreboard_result_' in filename:
+        names = ('victory', 'defeat', 'draw')
+        regions = {}
+    else:
+        names = ('scoreboard', 'my_team')
+        # scan_rows reads from one pixel above the level box corner
+        regions = {f'level_{i}': (x, y - 1, archive_strip_width, 18) for i, (x, y) in enumerate(level_boxes_top_left)}
+    for name in names:
+        template = base_templates[name]
+        regions[name] = (template['x'], template['y'], template['w'], template['h'])
+    return regions
+
+
+def get_screenshot_archive():
+    global screenshot_archive
+    if screenshot_archive is None:
+        screenshot_archive = archive.Archive(os.path.join(screenshots_dir, os.path.basename(archive.pack_file)),
+                                             os.path.join(screenshots_dir, os.path.basename(archive.index_file)))
+    return screenshot_archive
+
+
+def save_screenshot(filename, img, frame_layout):
+    if archive_mode != 'pack':
+        save_png(filename, img)
+        return
+    with metrics.stage('archive_write'):
+        get_screenshot_archive().add(os.path.basename(filename), layouts.to_base(img, frame_layout),
+                                     get_archive_regions(filename), archive_preview_scale)
+
+
+def has_frame_changed(pil_image):
+    with metrics.stage('gate'):
+        # every frame counts while the scoreboard rows are being voted on
+        return frame_gate.has_changed(pil_image, waiting_for) or scoreboard_consensus is not None
+
+
+def get_state():
+    return {'waiting_for': waiting_for, 'current_match': current_match}
+
+
+def resolve_match(match):
+    # players are a future while the scoreboard is still being recognized
+    if match is not None and isinstance(match['players'], concurrent.futures.Future):
+        return dict(match, players=match['players'].result())
+    return match
+
+
+def save_state(state=None):
+    state = get_state() if state is None else dict(state)
+    try:
+        state['current_match'] = resolve_match(state['current_match'])
+    except Exception:
+        # recognition failed, check_recognition saves the state it goes back to
+        return
+    with open(state_file, 'w') as f:
+        json.dump(state, f, indent=1)
 
 
 def load_state():
     global waiting_for, current_match
-    with open('state.json') as f:
+    with open(state_file) as f:
         state = json.load(f)
         waiting_for = state['waiting_for']
         current_match = state['current_match']
@@ -385,18 +753,93 @@ def load_state():
 
 def ensure_file_structure():
     global waiting_for, current_match
-    if not os.path.isfile('state.json'):
-        with open('state.json', 'w') as f:
+    if not os.path.isfile(state_file):
+        with open(state_file, 'w') as f:
             json.dump({'waiting_for': waiting_for,
                        'current_match': current_match}, f)
-    if not os.path.isfile('results.json'):
-        with open('results.json', 'w') as f:
+    if not os.path.isfile(results_file):
+        with open(results_file, 'w') as f:
             json.dump([], f)
-    if not os.path.isfile('results_short.json'):
-        with open('results_short.json', 'w') as f:
+    if not os.path.isfile(results_short_file):
+        with open(results_short_file, 'w') as f:
             json.dump([], f)
-    Path("./scoreboards").mkdir(parents=True, exist_ok=True)
-    Path("./scoreboards_errors").mkdir(parents=True, exist_ok=True)
+    if storage_mode == 'jsonl':
+        # start the logs from the existing history, or take in the matches
+        # saved to the JSON files while the log was off, before compacting
+        storage.merge(results_file, results_log_file)
+        storage.merge(results_short_file, results_short_log_file)
+    Path(screenshots_dir).mkdir(parents=True, exist_ok=True)
+    Path(errors_dir).mkdir(parents=True, exist_ok=True)
+
+
+def save_match(result, filename, match):
+    global matches_since_compaction
+    match = resolve_match(match)
+    with metrics.stage('json_write'):
+        match = {'result': result, 'result_file': filename,
+                 'scoreboard_file': match['scoreboard_file'], 'players': match['players']}
+        # the full record goes first, a level that can't be summed must not lose it
+        if storage_mode == 'jsonl':
+            storage.append_match(results_log_file, match)
+        else:
+            append_to_array(results_file, match)
+        if use_match_db:
+            # the database is only for stats, the logs above stay the record
+            try:
+                # the connection is made on the thread that writes the matches
+                with get_match_db() as conn:
+                    matchdb.add_match(conn, match)
+            except Exception as err:
+                metrics.count('errors')
+                log("Can't add the match to", matchdb.db_file, err)
+        try:
+            match_short = {'result': result, 'result_file': filename, 'players': list(
+                map(get_player_level, match['players']))}
+        except (KeyError, TypeError, ValueError) as err:
+            metrics.count('errors')
+            log("Can't save the short result of", filename, err)
+        else:
+            if storage_mode == 'jsonl':
+                storage.append_match(results_short_log_file, match_short)
+            else:
+                append_to_array(results_short_file, match_short)
+        if storage_mode == 'jsonl':
+            matches_since_compaction += 1
+            if matches_since_compaction >= compact_every:
+                compact_results()
+
+
+def append_to_array(path, entry):
+    with open(path, "r+") as file:
+        results_array = json.load(file)
+        results_array.append(entry)
+        file.seek(0)
+        json.dump(results_array, file, indent=1)
+
+
+def save_scoreboard(filename, img, players, frame_layout):
+    """
+    Archives a scoreboard screenshot once its recognition has finished, as
+    a full PNG in scoreboards_errors if it failed
+    """
+    if players.exception() is not None:
+        save_png(get_error_file(filename), img)
+        return
+    save_screenshot(filename, img, frame_layout)
+
+
+def get_match_db():
+    global match_db
+    if match_db is None:
+        match_db = matchdb.connect(matchdb.db_file)
+    return match_db
+
+
+def compact_results():
+    global matches_since_compaction
+    storage.compact(results_log_file, results_file)
+    storage.compact(results_short_log_file, results_short_file)
+    matches_since_compaction = 0
 
 
 def get_player_level(player):
@@ -418,103 +861,301 @@ def log(*args):
         last_log = args
 
 
-def main():
-    if ctypes.windll.shell32.IsUserAnAdmin() == 0:
-        log('Please run as administrator')
-        exit(0)
-
-    global waiting_for, current_match, pause_between_screenshots
-    ensure_file_structure()
-
-    log('-- Searching for Overwatch.exe')
-    overwatch_pid = get_pid()
-    log('-- Overwatch PID is', overwatch_pid)
-    while get_pid_state(overwatch_pid) == 2:
-        log('-- Overwatch is minimized')
-        time.sleep(5)
-    log('-- Overwatch is open, initializing')
-    time.sleep(4)  # Pause before initializing
-    # screen_recorder.enable_dev_log()
-    screen_recorder.disable_log()
-    screen_recorder.init_resources(overwatch_pid)
-    log('-- Initialized resources')
-    load_state()
-    log('-- Loaded state:', waiting_for,
-        current_match['scoreboard_file'] if current_match is not None else None)
-
-    prev_pid_state = 1
-    pid_state = 1
-
+def capture_frames(source, poll_scheduler):
+    """
+    Yields (pil_image, cycle_time) for every changed frame until the source
+    has no more, paced by poll_scheduler while the source is live
+    """
+    global frames_captured
+    prev_pid_state = capture.normal
+    pid_state = capture.normal
     while True:
-        time.sleep(pause_between_screenshots)
-        cycle_time = time.strftime("%Y-%m-%d-%H-%M-%S")
+        if source.live:
+            poll_scheduler.wait()
 
         prev_pid_state = pid_state
-        pid_state = get_pid_state(overwatch_pid)
-        if pid_state == 2:
+        pid_state = source.get_state()
+        if pid_state == capture.minimized:
             log('-- Overwatch is minimized')
+            poll_scheduler.update(waiting_for, minimized=True)
             continue
         if pid_state is None:
-            log('Overwatch has closed')
-            exit(0)
+            return
 
-        if prev_pid_state == 2:
+        if prev_pid_state == capture.minimized and source.live:
             time.sleep(5)
 
-        pil_image = None
-        try:
-            pil_image = screen_recorder.get_screenshot(1)
-        except screen_recorder.RecorderError as err:
-            log(f"Error taking screenshot", err)
-            restart_program()
+        with metrics.stage('capture'):
+            pil_image, cycle_time = source.get_frame()
+        frames_captured += 1
+        metrics.count('frames')
+        if pil_image and use_frame_gate and not has_frame_changed(pil_image):
+            metrics.count('frames_skipped')
+            if frame_gate.skipped % 60 == 0:
+                log('-- Skipped unchanged frames:', frame_gate.skipped)
+            poll_scheduler.update(waiting_for, changed=False)
+            continue
         if pil_image:
-            img = pil_to_cv2_image(pil_image)
-            if waiting_for == 'scoreboard':
-                log('-- Waiting for a SCOREBOARD')
-                match, value = is_matched(img, scoreboard_template)
-                if match:
-                    log('Found scoreboard', match, value)
-                    # This screenshot shows scoreboard
-                    try:
-                        filename = f'./scoreboards/scoreboard_{cycle_time}.png'
-                        players = recognize_scoreboard(img)
-                        current_match = {
-                            'scoreboard_file': filename, 'players': players}
-                        waiting_for = 'result'
-                        cv2.imwrite(filename, img, [
-                                    cv2.IMWRITE_PNG_COMPRESSION, 9])
-                        save_state()
-                    except:
-                        filename = f'./scoreboards_errors/scoreboard_{cycle_time}.png'
-                        cv2.imwrite(filename, img, [
-                                    cv2.IMWRITE_PNG_COMPRESSION, 9])
-                        traceback.print_exc(file=sys.stdout)
-                        log(f"Error recognizing {filename}")
-            if waiting_for == 'result':
-                log('-- Waiting for a RESULT')
+            yield pil_image, cycle_time
+        # the state after this frame decides how soon to look again
+        poll_scheduler.update(waiting_for)
+
+
+def recognize_frame(img):
+    with metrics.stage('recognize'):
+        players = list(recognize_rows(img).values())
+    # with consensus the table is printed once, by finish_consensus
+    if not use_consensus:
+        print_scoreboard(players)
+    return players
+
+
+def check_recognition(writer):
+    """
+    Keeps the players of the tracked match once they are recognized, or goes
+    back to waiting for a scoreboard if the recognition failed
+    """
+    global waiting_for, current_match, scoreboard_consensus
+    players = current_match['players'] if current_match is not None else None
+    if not isinstance(players, concurrent.futures.Future) or not players.done():
+        return
+    err = players.exception()
+    if err is None:
+        current_match = dict(current_match, players=players.result())
+        if scoreboard_consensus is not None:
+            scoreboard_consensus.add(dict(enumerate(current_match['players'])))
+        return
+    scoreboard_consensus = None
+    metrics.count('errors')
+    traceback.print_exception(type(err), err, err.__traceback__, file=sys.stdout)
+    log(f"Error recognizing {get_error_file(current_match['scoreboard_file'])}")
+    waiting_for = 'scoreboard'
+    current_match = None
+    writer.submit(save_state, get_state())
+
+
+def recognize_votes(img, indexes):
+    metrics.count('consensus_rows', len(indexes))
+    with metrics.stage('recognize'):
+        return recognize_rows(img, indexes)
+
+
+def collect_votes():
+    """
+    Adds the rows read on the last consensus frame once they are done.
+    Returns False while they are still being read
+    """
+    global current_match, consensus_pending
+    if consensus_pending is None:
+        return True
+    if not consensus_pending.done():
+        return False
+    votes, consensus_pending = consensus_pending, None
+    # a frame that could not be read does not vote, but still counts toward max_frames
+    if votes.exception() is None:
+        scoreboard_consensus.add(votes.result())
+        current_match = dict(current_match, players=scoreboard_consensus.get_players())
+    else:
+        scoreboard_consensus.add({})
+    return True
+
+
+def finish_consensus(writer):
+    global scoreboard_consensus, consensus_pending
+    log(f"-- Scoreboard read on {scoreboard_consensus.frames} frames, "
+        f"rows without agreement: {scoreboard_consensus.unsettled()}")
+    scoreboard_consensus = None
+    consensus_pending = None
+    players = current_match['players']
+    if isinstance(players, concurrent.futures.Future):
+        # the result showed up before the first reading was done
+        players.add_done_callback(lambda done: done.exception() is None and print_scoreboard(done.result()))
+    else:
+        print_scoreboard(players)
+    writer.submit(save_state, get_state())
+
+
+def update_consensus(pil_image, recognizer, writer):
+    """
+    While the scoreboard stays open, reads again only the rows the frames so
+    far disagree on, until every row has agreed or the scoreboard closes
+    """
+    global consensus_pending
+    # the first reading is added by check_recognition
+    if isinstance(current_match['players'], concurrent.futures.Future) or not collect_votes():
+        return
+    if scoreboard_consensus.is_done():
+        finish_consensus(writer)
+        return
+    with metrics.stage('convert'):
+        region, origin = frames.convert_region(pil_image, scoreboard_regions)
+    with metrics.stage('match'):
+        match, value = is_matched(region, scoreboard_template, origin=origin)
+    if not match:
+        finish_consensus(writer)
+        return
+    with metrics.stage('convert'):
+        img = pil_to_cv2_image(pil_image)
+    consensus_pending = recognizer.submit(recognize_votes, img, scoreboard_consensus.unsettled())
+
+
+def process_frame(pil_image, cycle_time, writer, recognizer):
+    """
+    Runs the state machine on a frame. Scoreboards are recognized on
+    recognizer and files are written by writer, so both can still be in
+    progress when this returns
+    """
+    global waiting_for, current_match, scoreboard_consensus
+    if layout['size'] != pil_image.size:
+        log('-- Using layout', apply_layout(*pil_image.size)['name'])
+    check_recognition(writer)
+    # the full frame is only converted to recognize or save it
+    img = None
+    if waiting_for == 'scoreboard':
+        log('-- Waiting for a SCOREBOARD')
+        with metrics.stage('convert'):
+            region, origin = frames.convert_region(pil_image, scoreboard_regions)
+        with metrics.stage('match'):
+            match, value = is_matched(region, scoreboard_template, origin=origin)
+        if match:
+            log('Found scoreboard', match, value)
+            metrics.count('scoreboards')
+            with metrics.stage('convert'):
+                img = pil_to_cv2_image(pil_image)
+            # This screenshot shows scoreboard
+            filename = f'{screenshots_dir}/scoreboard_{cycle_time}.png'
+            players = recognizer.submit(recognize_frame, img)
+            current_match = {'scoreboard_file': filename, 'players': players}
+            waiting_for = 'result'
+            if use_consensus:
+                scoreboard_consensus = consensus.Consensus(
+                    len(level_boxes_top_left), consensus_agree, consensus_max_frames)
+            writer.submit(save_scoreboard, filename, img, players, layout)
+            writer.submit(save_state, get_state())
+            check_recognition(writer)
+    elif waiting_for == 'result' and scoreboard_consensus is not None:
+        update_consensus(pil_image, recognizer, writer)
+    if waiting_for == 'result':
+        log('-- Waiting for a RESULT')
+        if img is None:
+            with metrics.stage('convert'):
+                region, origin = frames.convert_region(pil_image, result_regions)
+            with metrics.stage('match'):
+                result, value = match_result(region, origin)
+        else:
+            with metrics.stage('match'):
                 result, value = match_result(img)
-                if result is not None:
-                    log(f"Found result: {result}, confidence: {value}")
-                    filename = current_match['scoreboard_file'].replace(
-                        'scoreboard_', 'scoreboard_result_')
-                    cv2.imwrite(filename, img, [
-                                cv2.IMWRITE_PNG_COMPRESSION, 9])
-                    with open("results.json", "r+") as file:
-                        results_array = json.load(file)
-                        results_array.append({'result': result, 'result_file': filename,
-                                              'scoreboard_file': current_match['scoreboard_file'], 'players': current_match['players']})
-                        file.seek(0)
-                        json.dump(results_array, file, indent=1)
-                    with open("results_short.json", "r+") as file:
-                        results_array = json.load(file)
-                        results_array.append({'result': result, 'result_file': filename, 'players': list(
-                            map(get_player_level, current_match['players']))})
-                        file.seek(0)
-                        json.dump(results_array, file, indent=1)
-                    waiting_for = 'scoreboard'
-                    current_match = None
-                    save_state()
+        if result is not None:
+            log(f"Found result: {result}, confidence: {value}")
+            metrics.count('matches')
+            if img is None:
+                with metrics.stage('convert'):
+                    img = pil_to_cv2_image(pil_image)
+            scoreboard_file = current_match['scoreboard_file']
+            filename = os.path.join(os.path.dirname(scoreboard_file),
+                                    os.path.basename(scoreboard_file).replace('scoreboard_', 'scoreboard_result_'))
+            writer.submit(save_screenshot, filename, img, layout)
+            if scoreboard_consensus is not None:
+                finish_consensus(writer)
+            writer.submit(save_match, result, filename, current_match)
+            waiting_for = 'scoreboard'
+            current_match = None
+            writer.submit(save_state, get_state())
+
+
+def main(source=None):
+    global frames_captured
+    setup_started = time.perf_counter()
+    if source is None:
+        source = capture.ScreenRecorderSource(log)
+    ensure_file_structure()
+
+    # with recognition_use_processes each child starts its own pool instead
+    if use_tesseract_pool and pytesseract.tesserocr_installed and not (recognition_workers and recognition_use_processes):
+        # one worker per thread that reads levels at once
+        pytesseract.start_pool(max(recognition_workers, 1))
+        log('-- Started tesseract worker pool')
+    pytesseract.enable_cache(path=ocr_cache_file)
+
+    source.open()
+    load_state()
+    if storage_mode == 'jsonl':
+        compact_results()
+    log('-- Loaded state:', waiting_for,
+        current_match['scoreboard_file'] if current_match is not None else None)
+
+    frames_captured = 0
+    started = time.time()
+
+    poll_scheduler = scheduler.PollScheduler(
+        min_pause_between_screenshots, max_pause_between_screenshots, pause_between_screenshots)
+    frame_source = capture_frames(source, poll_scheduler)
+    if use_pipeline:
+        # replays wait for the processing instead of dropping frames
+        frame_source = pipeline.CaptureThread(frame_source, frame_queue_size, drop=source.live)
+        frame_source.start()
+        recognizer = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='recognize')
+        writer = pipeline.Writer()
+        writer.start()
+    else:
+        recognizer = pipeline.InlineExecutor()
+        writer = pipeline.InlineWriter()
+
+    capture_error = None
+    first_frame = True
+    try:
+        for pil_image, cycle_time in frame_source:
+            if first_frame:
+                first_frame = False
+                elapsed = time.perf_counter() - import_started
+                metrics.observe('time_to_first_frame', elapsed * 1000)
+                log(f"-- First frame after {elapsed:.2f}s, imports and templates took {setup_started - import_started:.2f}s")
+            process_frame(pil_image, cycle_time, writer, recognizer)
+    except capture.CaptureError as err:
+        capture_error = err
+    finally:
+        if use_pipeline:
+            frame_source.stop()
+        # finish the recognition and writes in progress before exiting or restarting
+        recognizer.shutdown(wait=True)
+        writer.close()
+        if storage_mode == 'jsonl':
+            compact_results()
+        metrics.flush()
+        pytesseract.disable_cache()
+
+    if capture_error is not None:
+        metrics.count('errors')
+        log(f"Error taking screenshot", capture_error)
+        restart_program()
+    source.close()
+    if source.live:
+        log('Overwatch has closed')
+    else:
+        elapsed = time.time() - started
+        log(f"-- Replayed {frames_captured} frames in {elapsed:.1f}s, {frames_captured / max(elapsed, 1e-6):.1f} frames/s")
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Tracks Overwatch matches')
+    parser.add_argument('--replay', metavar='PATH',
+                        help='read frames from a directory of PNGs or a video file instead of the screen')
+    parser.add_argument('--replay-output', default='./replay_output', metavar='DIR',
+                        help='where a replay writes its state, results and screenshots (%(default)s), '
+                             'so the live files are left alone')
+    parser.add_argument('--stats', nargs='?', const=metrics_file, metavar='FILE',
+                        help=f'record stage timings and counters, written to FILE ({metrics_file})')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='record stats and serve them at http://127.0.0.1:PORT/metrics')
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.stats or args.metrics_port:
+        metrics.enable(args.stats or metrics_file, port=args.metrics_port)
+    if args.replay:
+        set_output_dir(args.replay_output)
+    main(capture.ReplaySource(args.replay) if args.replay else None)
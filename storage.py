@@ -0,0 +1,121 @@
+"""
+Append-only match log.
+
+Every match is one JSON line, so saving a match costs the same no matter
+how long the history is, and a crash can only damage the last line.
+The log is compacted into the usual results.json / results_short.json
+arrays from time to time, and can be converted both ways:
+
+    python storage.py to-jsonl results.json results.jsonl
+    python storage.py to-json results.jsonl results.json
+"""
+
+import json
+import os
+import sys
+from itertools import chain
+from os.path import exists
+
+
+def append_match(path, entry):
+    with open(path, 'a') as file:
+        file.write(json.dumps(entry) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def iter_matches(path):
+    """
+    Lazily yields the entries of a log, skipping a line left unfinished by a crash
+    """
+    if not exists(path):
+        return
+    with open(path) as file:
+        for line in file:
+            if not line.endswith('\n'):
+                break
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def write_array(path, entries):
+    """
+    Streams entries into a JSON array formatted like json.dump(..., indent=1),
+    replacing the file only once it is fully written
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        count = 0
+        for entry in entries:
+            file.write('[\n' if count == 0 else ',\n')
+            file.write('\n'.join(' ' + line for line in json.dumps(entry, indent=1).split('\n')))
+            count += 1
+        file.write('\n]' if count else '[]')
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+    return count
+
+
+def write_log(path, entries):
+    temp_path = path + '.tmp'
+    count = 0
+    with open(temp_path, 'w') as file:
+        for entry in entries:
+            file.write(json.dumps(entry) + '\n')
+            count += 1
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+    return count
+
+
+def iter_array(path):
+    if not exists(path):
+        return iter(())
+    with open(path) as file:
+        return iter(json.load(file))
+
+
+def json_to_jsonl(json_path, jsonl_path):
+    return write_log(jsonl_path, iter_array(json_path))
+
+
+def jsonl_to_json(jsonl_path, json_path):
+    return write_array(json_path, iter_matches(jsonl_path))
+
+
+def merge(json_path, jsonl_path):
+    """
+    Appends the matches of the JSON array that are missing from the log, as
+    saved by a run with the log turned off, so compacting does not drop them.
+    Returns how many were added
+    """
+    logged = {json.dumps(entry, sort_keys=True) for entry in iter_matches(jsonl_path)}
+    missing = [entry for entry in iter_array(json_path) if json.dumps(entry, sort_keys=True) not in logged]
+    if missing or not exists(jsonl_path):
+        write_log(jsonl_path, chain(iter_matches(jsonl_path), missing))
+    return len(missing)
+
+
+def compact(jsonl_path, json_path):
+    """
+    Drops damaged lines from the log and refreshes the JSON array snapshot
+    """
+    write_log(jsonl_path, iter_matches(jsonl_path))
+    return jsonl_to_json(jsonl_path, json_path)
+
+
+def main():
+    commands = {'to-jsonl': json_to_jsonl, 'to-json': jsonl_to_json, 'compact': compact}
+    if len(sys.argv) != 4 or sys.argv[1] not in commands:
+        sys.stderr.write('Usage: python storage.py to-jsonl|to-json|compact source destination\n')
+        exit(2)
+    count = commands[sys.argv[1]](sys.argv[2], sys.argv[3])
+    print(f"Wrote {count} matches")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Template and mask images in one precompiled file.
+
+The PNGs in ./templates are decoded once into templates.bank, which is
+rebuilt whenever one of them changes. Loading memory-maps the bank, so the
+pixels are only read from disk when a template is first used.
+
+    8 bytes   header length, little endian
+    header    JSON {"sources": {name: [size, mtime_ns]},
+                    "arrays": {name: [shape, dtype, offset]}}
+    data      the arrays, each starting on a 64 byte boundary
+"""
+
+import json
+import mmap
+import os
+
+import numpy as np
+
+source_dir = './templates'
+bank_file = './templates/templates.bank'
+alignment = 64
+
+
+def get_source_path(name):
+    return os.path.join(source_dir, f'{name}.png')
+
+
+def get_sources(names):
+    sources = {}
+    for name in names:
+        try:
+            stat = os.stat(get_source_path(name))
+            sources[name] = [stat.st_size, stat.st_mtime_ns]
+        except OSError:
+            sources[name] = None
+    return sources
+
+
+def read_header(path):
+    try:
+        with open(path, 'rb') as file:
+            header_length = int.from_bytes(file.read(8), 'little')
+            return json.loads(file.read(header_length)), 8 + header_length
+    except (OSError, ValueError):
+        return None, 0
+
+
+def build(names, path=bank_file):
+    import cv2
+
+    images = {name: cv2.imread(get_source_path(name)) for name in names}
+    header = {'sources': get_sources(names), 'arrays': {}}
+    offset = 0
+    for name, image in images.items():
+        if image is None:
+            continue
+        header['arrays'][name] = [list(image.shape), image.dtype.str, offset]
+        offset += -(-image.nbytes // alignment) * alignment
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(8 + len(header_bytes)) // alignment) * alignment
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(len(header_bytes).to_bytes(8, 'little'))
+        file.write(header_bytes)
+        for name, (shape, dtype, array_offset) in header['arrays'].items():
+            file.seek(data_start + array_offset)
+            file.write(np.ascontiguousarray(images[name]).tobytes())
+    os.replace(temp_path, path)
+
+
+def load(names, path=bank_file):
+    """
+    Returns {name: image} for the named PNGs in source_dir, None for the
+    missing ones. The images are read-only views of the mapped bank
+    """
+    header, header_end = read_header(path)
+    if header is None or header['sources'] != get_sources(names):
+        build(names, path)
+        header, header_end = read_header(path)
+    data_start = -(-header_end // alignment) * alignment
+    with open(path, 'rb') as file:
+        # the arrays keep the mapping alive, the file itself can be closed
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    images = {name: None for name in names}
+    for name, (shape, dtype, offset) in header['arrays'].items():
+        if name in images:
+            images[name] = np.ndarray(shape, dtype=dtype, buffer=mapped, offset=data_start + offset)
+    return images